@@ -9,6 +9,7 @@ from jinja2 import Environment, FileSystemLoader
 
 
 from www import orm
+from www.config import configs
 from www.webcore import add_routes, add_static
 from www.handlers import cookie2user, COOKIE_NAME
 
@@ -44,11 +45,42 @@ def init_jinja2(app, **kw):
 async def logger_factory(app, handler):
     async def logger(request):
         logging.info('Request: %s %s' % (request.method, request.path))
-        return await handler(request)
+        # 慢查询日志中记录发起查询的handler
+        route = getattr(request.match_info, 'handler', None)
+        name = getattr(getattr(route, '_func', route), '__name__', None) or request.path
+        with orm.request_context(name):
+            return await handler(request)
 
     return logger
 
 
+async def budget_factory(app, handler):
+    """
+    限制每个请求同时持有的数据库连接数，单个页面的并发查询不会耗尽连接池
+    """
+    async def budget(request):
+        with orm.connection_budget(configs.db.get('request_connections', 3)):
+            return await handler(request)
+
+    return budget
+
+
+async def deadline_factory(app, handler):
+    """
+    为每个请求的数据库操作设置截止时间，超时的语句在服务器端被终止，连接不会被慢查询长期占用
+    客户端断开连接时handler被取消，正在执行的语句同样会被终止
+    """
+    async def deadline(request):
+        try:
+            with orm.deadline(configs.db.get('request_timeout', 10)):
+                return await handler(request)
+        except orm.DeadlineExceeded:
+            logging.warning('database deadline exceeded: %s %s' % (request.method, request.path))
+            return web.HTTPServiceUnavailable()
+
+    return deadline
+
+
 async def data_factory(app, handler):
     """
 
@@ -111,7 +143,7 @@ async def response_factory(app, handler):
                 1. 通过API获取数据，序列化response结果为JSON                
                 """
                 resp = web.Response(
-                    body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                    body=json.dumps(r, ensure_ascii=False, default=lambda o: o._asdict() if hasattr(o, '_asdict') else o.__dict__).encode('utf-8'))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
@@ -150,10 +182,12 @@ def datetime_filter(t):
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
 async def init(loop):
-    await orm.create_pool(loop=loop, user='root', password='fjzhang', db='webapp_test')
+    await orm.create_pool(loop=loop, user='root', password='fjzhang', db='webapp_test',
+                          warm=configs.db.get('warm', 0), keepalive=configs.db.get('keepalive'),
+                          max_age=configs.db.get('max_age'))
     print('after create pool')
     app = web.Application(loop=loop, middlewares=[
-        logger_factory, auth_factory, response_factory
+        logger_factory, deadline_factory, budget_factory, auth_factory, response_factory
     ])
     init_jinja2(app, filters=dict(datetime=datetime_filter))
     add_routes(app, 'handlers')
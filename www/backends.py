@@ -0,0 +1,458 @@
+# -*- coding:utf-8 -*-
+"""
+ORM的数据库后端
+
+orm中的select/execute/iterate只依赖后端提供的连接池、连接和游标接口（与aiomysql一致）：
+- 连接池：acquire()、release(conn)、close()、wait_closed()、size、freesize、minsize、maxsize
+- 连接：cursor(cls)、begin()、commit()、rollback()、ping()、close()，MySQL连接还需要thread_id()
+- 游标：execute(sql, args)、fetchall()、fetchmany(size)、rowcount
+后端同时负责占位符风格和各数据库之间的DDL、EXPLAIN差异。
+
+MySQLBackend基于aiomysql；
+SQLiteBackend基于标准库sqlite3，每个连接在自己的线程中执行阻塞调用，不需要额外安装驱动。
+"""
+
+import asyncio, collections, concurrent.futures, logging, sqlite3, weakref
+
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+__author__ = 'fjzhang'
+
+
+class Backend(object):
+    """ 数据库后端的基类 """
+
+    name = None
+    # 驱动使用的占位符，ORM的SQL模板统一使用?
+    placeholder = '?'
+    # 普通游标、返回dict的游标以及对应的流式（服务器端）游标
+    Cursor = DictCursor = SSCursor = SSDictCursor = None
+
+    async def create_pool(self, loop, kw):
+        raise NotImplementedError
+
+    def create_table_sql(self, table, columns, primary_key, indexes):
+        """
+        :param columns: [(列名, 类型)]
+        :param indexes: [(索引名, [列名], 是否唯一)]
+        :return: CREATE TABLE语句
+        """
+        raise NotImplementedError
+
+    def create_index_sql(self, table, indexes):
+        """ 返回CREATE INDEX语句列表 """
+        return ['create %sindex `%s` on `%s` (%s)' % ('unique ' if unique else '', name, table,
+                                                     ', '.join('`%s`' % c for c in columns))
+                for name, columns, unique in indexes]
+
+    def approximate_count_sql(self, table):
+        """ 返回读取表行数估算值的(sql, args)，结果列名为_num_ """
+        return 'select count(*) _num_ from `%s`' % table, []
+
+    def insert_ignore_sql(self, insert):
+        """ 把INSERT语句改写为忽略主键和唯一索引冲突的INSERT """
+        raise NotImplementedError
+
+    def upsert_sql(self, insert, columns):
+        """
+        把INSERT语句改写为冲突时更新已有行columns的语句，影响行数1表示插入、2表示更新、0表示没有变化；
+        不能用一条语句区分插入和更新时返回None，由调用者先INSERT IGNORE再UPDATE
+        """
+        return None
+
+    def explain_sql(self, sql):
+        return 'explain ' + sql
+
+    def duplicate_key(self, exc, table, index, columns):
+        """
+        exc是否为INSERT与唯一索引冲突引起的异常
+        :param index: 索引名，主键为'PRIMARY'；为None时匹配任意唯一键
+        :param columns: 索引的列名
+        """
+        return False
+
+    def plan_problems(self, row):
+        """ 从EXPLAIN结果的一行中找出全表扫描、filesort等问题 """
+        return []
+
+    def interrupt(self, pool, conn):
+        """
+        终止conn上正在执行的语句，在conn关闭之前调用
+        需要异步完成的操作以协程的形式返回，由调用者在后台执行；没有则返回None
+        """
+        return None
+
+
+class MySQLBackend(Backend):
+    """ 基于aiomysql的MySQL后端 """
+
+    name = 'mysql'
+    placeholder = '%s'
+    if aiomysql is not None:
+        Cursor = aiomysql.Cursor
+        DictCursor = aiomysql.DictCursor
+        SSCursor = aiomysql.SSCursor
+        SSDictCursor = aiomysql.SSDictCursor
+
+    def __init__(self):
+        # 每个连接池的连接参数，用于建立发送KILL QUERY的专用连接
+        self._options = weakref.WeakKeyDictionary()
+
+    async def create_pool(self, loop, kw):
+        if aiomysql is None:
+            raise ImportError('MySQL backend requires aiomysql.')
+        # **kw参数可以包含所有连接需要用到的关键字参数
+        options = dict(
+            host=kw.get('host', 'localhost'),  # 默认本机IP
+            port=kw.get('port', 3306),
+            user=kw['user'],
+            password=kw['password'],
+            db=kw['db'],
+            charset=kw.get('charset', 'utf8'),  # 给自己挖了一个大坑：utf-8，报错根本提示不到这
+            autocommit=kw.get('autocommit', True),
+        )
+        pool = await aiomysql.create_pool(
+            maxsize=kw.get('maxsize', 10),  # 默认最大连接数为10
+            minsize=kw.get('minsize', 1),
+            # aiomysql在补充空闲连接时关闭闲置超过pool_recycle秒的连接，连接的最长使用时间由orm.PoolHealth控制
+            pool_recycle=kw.get('max_age') or -1,
+            loop=loop,  # 接受一个event_loop实例
+            **options
+        )
+        self._options[pool] = options
+        return pool
+
+    def create_table_sql(self, table, columns, primary_key, indexes):
+        L = ['    `%s` %s not null' % (name, ddl) for name, ddl in columns]
+        for name, keys, unique in indexes:
+            L.append('    %skey `%s` (%s)' % ('unique ' if unique else '', name, ', '.join('`%s`' % c for c in keys)))
+        L.append('    primary key (`%s`)' % primary_key)
+        return 'create table `%s` (\n%s\n) engine=innodb default charset=utf8;' % (table, ',\n'.join(L))
+
+    def approximate_count_sql(self, table):
+        return ('select `table_rows` _num_ from information_schema.tables '
+                'where `table_schema`=database() and `table_name`=?', [table])
+
+    def insert_ignore_sql(self, insert):
+        # INSERT IGNORE同时会把数据截断等错误降级为警告
+        return 'insert ignore' + insert[len('insert'):]
+
+    def upsert_sql(self, insert, columns):
+        return '%s on duplicate key update %s' % (insert, ', '.join('`%s`=values(`%s`)' % (c, c) for c in columns))
+
+    def duplicate_key(self, exc, table, index, columns):
+        # ER_DUP_ENTRY: "Duplicate entry 'x' for key 'idx_email'"，MySQL 8.0的键名带有表名前缀
+        if aiomysql is None or not isinstance(exc, aiomysql.IntegrityError) or exc.args[:1] != (1062,):
+            return False
+        if index is None:
+            return True
+        message = str(exc.args[1]) if len(exc.args) > 1 else ''
+        return message.endswith(("'%s'" % index, "'%s.%s'" % (table, index)))
+
+    def interrupt(self, pool, conn):
+        # 关闭客户端连接并不会终止服务器上正在执行的语句，需要从另一个连接发送KILL QUERY
+        # 截止时间多在连接池占满时触发，从池中取连接要等待其他请求释放，因此KILL使用池外的专用短连接，
+        # 不占用maxsize和自适应上限
+        thread_id = conn.thread_id()
+        options = self._options.get(pool)
+        if options is None:
+            return None
+
+        async def kill():
+            killer = await aiomysql.connect(**options)
+            try:
+                async with killer.cursor() as cur:
+                    await cur.execute('kill query %d' % thread_id)
+            finally:
+                killer.close()
+        return kill()
+
+    def plan_problems(self, row):
+        problems = []
+        if row.get('type') == 'ALL':
+            problems.append('full scan')
+        extra = row.get('Extra') or ''
+        if 'Using filesort' in extra:
+            problems.append('filesort')
+        if 'Using temporary' in extra:
+            problems.append('temporary')
+        return problems
+
+
+class SQLiteCursor(object):
+    """ sqlite3游标的异步封装，所有阻塞调用都在连接的线程中执行 """
+
+    as_dict = False
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._cur = None
+        self.rowcount = -1
+        self.description = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def execute(self, sql, args=()):
+        def run():
+            cur = self._conn._db.cursor()
+            cur.execute(sql, tuple(args or ()))
+            return cur
+        self._cur = await self._conn._run(run)
+        self.rowcount = self._cur.rowcount
+        self.description = self._cur.description
+        return self.rowcount
+
+    def _rows(self, rows):
+        if not self.as_dict or self.description is None:
+            return rows
+        names = [d[0] for d in self.description]
+        return [dict(zip(names, r)) for r in rows]
+
+    async def fetchall(self):
+        if self._cur is None:
+            return []
+        return self._rows(await self._conn._run(self._cur.fetchall))
+
+    async def fetchmany(self, size=None):
+        if self._cur is None:
+            return []
+        return self._rows(await self._conn._run(self._cur.fetchmany, size or self._cur.arraysize))
+
+    async def fetchone(self):
+        rs = await self.fetchmany(1)
+        return rs[0] if rs else None
+
+    async def close(self):
+        cur, self._cur = self._cur, None
+        if cur is not None:
+            await self._conn._run(cur.close)
+
+
+class SQLiteDictCursor(SQLiteCursor):
+    as_dict = True
+
+
+class SQLiteConnection(object):
+    """
+    sqlite3连接的异步封装
+    每个连接拥有一个单线程的执行器，同一个连接上的调用按顺序在这个线程中执行
+    连接使用自动提交模式(isolation_level=None)，事务由begin()/commit()/rollback()显式控制
+    """
+
+    def __init__(self, database, loop, timeout=5.0):
+        self.database = database
+        self.closed = False
+        self._loop = loop
+        self._timeout = timeout
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._db = None
+
+    def _run(self, fn, *args):
+        return self._loop.run_in_executor(self._executor, fn, *args)
+
+    async def connect(self):
+        def run():
+            db = sqlite3.connect(self.database, timeout=self._timeout, isolation_level=None,
+                                 check_same_thread=False)
+            if self.database != ':memory:':
+                # WAL模式下读写不互相阻塞
+                db.execute('pragma journal_mode=wal')
+            return db
+        self._db = await self._run(run)
+        return self
+
+    def cursor(self, cursor=SQLiteCursor):
+        return cursor(self)
+
+    async def begin(self):
+        await self._run(self._db.execute, 'begin')
+
+    async def commit(self):
+        if self._db.in_transaction:
+            await self._run(self._db.execute, 'commit')
+
+    async def rollback(self):
+        if self._db.in_transaction:
+            await self._run(self._db.execute, 'rollback')
+
+    async def ping(self, reconnect=True):
+        await self._run(self._db.execute, 'select 1')
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._db is not None:
+            self._executor.submit(self._db.close)
+        self._executor.shutdown(wait=False)
+
+    async def ensure_closed(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._db is not None:
+            await self._run(self._db.close)
+        self._executor.shutdown(wait=False)
+
+
+class SQLitePool(object):
+    """
+    SQLite连接池，接口与aiomysql.Pool一致
+    内存数据库(':memory:')的每个连接都是独立的数据库，因此连接数固定为1
+    """
+
+    def __init__(self, database, minsize, maxsize, loop, timeout=5.0):
+        if database == ':memory:' and maxsize != 1:
+            logging.info('sqlite in-memory database: limit connection pool size to 1')
+            minsize = maxsize = 1
+        self.database = database
+        self.minsize = min(minsize, maxsize)
+        self.maxsize = maxsize
+        self._loop = loop
+        self._timeout = timeout
+        self._free = collections.deque()
+        self._used = set()
+        self._connecting = 0
+        self._cond = asyncio.Condition()
+        self._closed = False
+
+    @property
+    def size(self):
+        return len(self._free) + len(self._used) + self._connecting
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    async def _connect(self):
+        return await SQLiteConnection(self.database, self._loop, self._timeout).connect()
+
+    async def fill(self):
+        while self.size < self.minsize:
+            self._connecting += 1
+            try:
+                conn = await self._connect()
+            finally:
+                self._connecting -= 1
+            self._free.append(conn)
+
+    async def acquire(self):
+        if self._closed:
+            raise RuntimeError('Cannot acquire connection after closing pool')
+        async with self._cond:
+            while True:
+                while self._free:
+                    conn = self._free.popleft()
+                    if not conn.closed:
+                        self._used.add(conn)
+                        return conn
+                if self.size < self.maxsize:
+                    self._connecting += 1
+                    try:
+                        conn = await self._connect()
+                    finally:
+                        self._connecting -= 1
+                    self._used.add(conn)
+                    return conn
+                await self._cond.wait()
+
+    def release(self, conn):
+        self._used.discard(conn)
+        if not conn.closed:
+            if self._closed:
+                conn.close()
+            else:
+                self._free.append(conn)
+        return asyncio.ensure_future(self._wakeup())
+
+    async def _wakeup(self):
+        async with self._cond:
+            self._cond.notify()
+
+    def close(self):
+        self._closed = True
+
+    async def wait_closed(self):
+        while self._free:
+            await self._free.popleft().ensure_closed()
+
+
+class SQLiteBackend(Backend):
+    """
+    基于标准库sqlite3的后端，用于小型的读多写少部署和可重复的本地基准测试
+    create_pool(loop, backend='sqlite', database='webapp.db')
+    """
+
+    name = 'sqlite'
+    placeholder = '?'
+    Cursor = SSCursor = SQLiteCursor
+    DictCursor = SSDictCursor = SQLiteDictCursor
+
+    async def create_pool(self, loop, kw):
+        pool = SQLitePool(kw.get('database', ':memory:'), kw.get('minsize', 1), kw.get('maxsize', 10),
+                          loop or asyncio.get_event_loop(), kw.get('timeout', 5.0))
+        await pool.fill()
+        return pool
+
+    def create_table_sql(self, table, columns, primary_key, indexes):
+        # SQLite不支持在CREATE TABLE中定义普通索引，索引由create_index_sql单独创建
+        L = ['    `%s` %s not null' % (name, ddl) for name, ddl in columns]
+        L.append('    primary key (`%s`)' % primary_key)
+        return 'create table `%s` (\n%s\n);' % (table, ',\n'.join(L))
+
+    def create_index_sql(self, table, indexes):
+        # SQLite的索引名在整个数据库中唯一，加上表名作为前缀
+        return super(SQLiteBackend, self).create_index_sql(
+            table, [('%s_%s' % (table, name), columns, unique) for name, columns, unique in indexes])
+
+    def insert_ignore_sql(self, insert):
+        return 'insert or ignore' + insert[len('insert'):]
+
+    def explain_sql(self, sql):
+        return 'explain query plan ' + sql
+
+    def duplicate_key(self, exc, table, index, columns):
+        # "UNIQUE constraint failed: users.email"，消息中只有列名没有索引名
+        if not isinstance(exc, sqlite3.IntegrityError) or not str(exc).startswith('UNIQUE constraint failed: '):
+            return False
+        if index is None:
+            return True
+        return str(exc)[len('UNIQUE constraint failed: '):] == ', '.join('%s.%s' % (table, c) for c in columns)
+
+    def interrupt(self, pool, conn):
+        # sqlite3的interrupt()可以在其他线程中调用，正在执行的语句抛出OperationalError
+        if conn._db is not None:
+            conn._db.interrupt()
+        return None
+
+    def plan_problems(self, row):
+        problems = []
+        detail = row.get('detail') or ''
+        # 'SCAN comments'为全表扫描，'SCAN comments USING INDEX ...'为索引扫描
+        if detail.startswith('SCAN ') and ' USING ' not in detail:
+            problems.append('full scan')
+        if 'USE TEMP B-TREE FOR ORDER BY' in detail:
+            problems.append('filesort')
+        if 'USE TEMP B-TREE FOR' in detail and 'ORDER BY' not in detail:
+            problems.append('temporary')
+        return problems
+
+
+_BACKENDS = dict(mysql=MySQLBackend, sqlite=SQLiteBackend)
+
+
+def get_backend(backend):
+    """ 根据名称('mysql'或'sqlite')返回后端实例，已经是Backend实例时直接返回 """
+    if isinstance(backend, Backend):
+        return backend
+    try:
+        return _BACKENDS[backend]()
+    except KeyError:
+        raise ValueError('Invalid database backend: %s' % backend)
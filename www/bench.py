@@ -0,0 +1,144 @@
+"""
+ORM性能基准测试
+
+直接运行： python -m www.bench [名称 ...]
+不带参数时运行全部基准测试
+"""
+
+import asyncio
+import gc
+import logging
+import os
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+from www import orm
+from www.models import User, Blog, Comment
+
+__author__ = 'fjzhang'
+
+
+def _per_call(fn, number):
+    """ 取三次运行中最快的一次，返回每次调用的耗时（微秒） """
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e6
+
+
+def bench_statement_cache(number=200000):
+    """ 每条查询在发送给驱动之前的处理开销：语句缓存之前的日志和占位符替换，与现在的orm._prepare对比 """
+    queries = [
+        ('%s where `%s`=?' % (User.__select__, User.__primary_key__), ['x']),
+        (Blog.__insert__, ['x'] * len(Blog.__fields__) + ['x']),
+        (Comment.__update__, ['x'] * len(Comment.__fields__) + ['x']),
+        (Comment.__delete__, ['x']),
+    ]
+
+    def before():
+        # 缓存之前：每次都格式化日志字符串并做占位符替换
+        for sql, args in queries:
+            logging.info('SQL: %s' % sql)
+            sql.replace('?', '%s')
+
+    def after():
+        for sql, args in queries:
+            orm._prepare(sql, args)
+
+    def replace_only():
+        # 只有占位符替换、没有日志时的下限，语句缓存本身并不比一次replace更快
+        for sql, args in queries:
+            sql.replace('?', '%s')
+
+    t_before = _per_call(before, number) / len(queries)
+    t_after = _per_call(after, number) / len(queries)
+    print('statement cache: before %.3f us/query, after %.3f us/query (%.1fx), replace only %.3f us/query'
+          % (t_before, t_after, t_before / t_after, _per_call(replace_only, number) / len(queries)))
+    print('statement cache info: %s' % orm.statement_cache_info())
+
+
+def _traced(build):
+    """ 返回build()构造的对象保留的内存和构造期间的峰值内存（字节） """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    gc.collect()
+    return current, peak, elapsed
+
+
+def bench_compact_rows(count=1000000):
+    """ 1M条Comment记录：基于dict的Model与紧凑行对象的内存占用对比 """
+    names = [Comment.__primary_key__] + Comment.__fields__
+    # 行数据在统计之前生成，两种表示共享同样的值对象，只比较容器本身的开销
+    rows = [('%015d' % i, 'blog-%d' % (i % 100), 'user', 'name', 'about:blank', 'content', float(i))
+            for i in range(count)]
+    row = Comment.__row__
+
+    def build_models():
+        # 与findAll一致：fetchall返回DictCursor构造的dict列表，再逐个复制为Model
+        rs = [dict(zip(names, r)) for r in rows]
+        return [Comment(**r) for r in rs]
+
+    def build_compact():
+        return [row(*r) for r in rows]
+
+    for label, build in (('dict models', build_models), ('compact rows', build_compact)):
+        current, peak, elapsed = _traced(build)
+        print('%s: %d rows, retained %.1f MB (%.0f bytes/row), peak %.1f MB, %.2fs'
+              % (label, count, current / 1e6, current / count, peak / 1e6, elapsed))
+
+
+async def _save_comments(count, concurrency):
+    """ concurrency个协程并发保存共count条评论，返回耗时 """
+    queue = iter(range(count))
+
+    async def worker():
+        for i in queue:
+            await Comment(blog_id='blog-%d' % (i % 100), user_id='user', user_name='name',
+                          user_image='about:blank', content='content %d' % i).save()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return time.perf_counter() - start
+
+
+def bench_coalesced_saves(count=5000, concurrency=100):
+    """ 并发的Comment.save()：逐条INSERT与写入合并的每秒提交数对比（SQLite文件数据库） """
+    coalescer = Comment.__coalescer__
+
+    async def run():
+        with tempfile.TemporaryDirectory() as path:
+            await orm.create_pool(None, backend='sqlite', database=os.path.join(path, 'bench.db'), maxsize=10)
+            try:
+                await orm.execute(orm.create_table_sql(Comment), [])
+                for label, c in (('one insert per save', None),
+                                 ('coalesced saves', coalescer or orm.SaveCoalescer(Comment))):
+                    Comment.__coalescer__ = c
+                    elapsed = await _save_comments(count, concurrency)
+                    batches = c.info()['batches'] if c is not None else count
+                    print('%s: %d rows, %d commits, %.0f rows/s, %.0f commits/s'
+                          % (label, count, batches, count / elapsed, batches / elapsed))
+            finally:
+                Comment.__coalescer__ = coalescer
+                await orm.destroy_pool()
+
+    asyncio.run(run())
+
+
+BENCHMARKS = dict(
+    statement_cache=bench_statement_cache,
+    compact_rows=bench_compact_rows,
+    coalesced_saves=bench_coalesced_saves,
+)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    names = sys.argv[1:] or list(BENCHMARKS.keys())
+    for name in names:
+        BENCHMARKS[name]()
@@ -11,7 +11,12 @@ configs = {
         'port': '3306',
         'user': 'root',
         'password': 'fjzhang',
-        'db': 'webapp_test'
+        'db': 'webapp_test',
+        'request_connections': 3,  # 每个请求同时持有的最大连接数
+        'request_timeout': 10,  # 每个请求中数据库操作的截止时间（秒）
+        'warm': 5,  # 启动时预先建立的连接数
+        'keepalive': 60,  # 空闲连接的保活间隔（秒）
+        'max_age': 3600  # 连接的最长使用时间（秒）
     },
     'session': {
         'secret': 'fjzhang_webapp'
@@ -9,7 +9,7 @@ from www.webcore import get, post
 from www.models import User, Comment, Blog, next_id
 from www.apis import APIValueError, APIResourceNotFoundError, APIError, APIPermissionError
 from www.config import configs
-from www import markdown2
+from www import markdown2, orm
 
 __author__ = 'fjzhang'
 
@@ -42,6 +42,20 @@ def get_page_index(page_str):
     return p
 
 
+def get_page_cursor(cursor_str):
+    """
+    解析键集分页的续页令牌，令牌为空时返回None（即从第一页开始）
+    令牌无效时抛出APIValueError，而不是返回第一页，避免客户端带着损坏的令牌反复翻页
+    """
+    if not cursor_str:
+        return None
+    try:
+        orm.decode_cursor(cursor_str)
+    except ValueError:
+        raise APIValueError('cursor', 'Invalid page cursor.')
+    return cursor_str
+
+
 async def cookie2user(cookie_str):
     """
     解析cookie，如果cookie有效，则载入user
@@ -94,7 +108,7 @@ async def index(request):
 
 @get('/api/users')
 async def api_get_users(request):
-    users = await User.findAll(orderBy='created_at')
+    users = await User.query().order_by('created_at').all()
     for u in users:
         u.passwd = '******'
     return dict(users=users)
@@ -140,8 +154,8 @@ def text2html(text):
 
 @get('/blogs/{id}')
 async def get_blog(*, id):
-    blog = await Blog.find(id)
-    comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+    # 博客和评论互不依赖，并发查询
+    blog, comments = await orm.gather(Blog.find(id), Comment.query().where(blog_id=id).order_by('-created_at').all())
     for c in comments:
         c.html_content = text2html(c.content)
     blog.html_content = markdown2.markdown(blog.content)
@@ -152,12 +166,113 @@ async def get_blog(*, id):
     }
 
 
+@get('/api/blogs')
+async def api_blogs(*, cursor=None):
+    # 列表页不需要加载content
+    blogs, next_cursor = await Blog.findPage(after=get_page_cursor(cursor), size=10, order='created_at desc',
+                                             fields=['user_id', 'user_name', 'user_image', 'name', 'summary'])
+    return dict(blogs=blogs, next=next_cursor)
+
+
 @get('/api/blogs/{id}')
 async def api_get_blog(*, id):
     blog = await Blog.find(id)
     return blog
 
 
+def _metric_labels(labels):
+    return '{%s}' % ','.join('%s="%s"' % (k, v) for k, v in labels) if labels else ''
+
+
+def _histogram_lines(name, hist, labels=()):
+    L = []
+    for bound, count in hist['buckets']:
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        L.append('%s_bucket%s %s' % (name, _metric_labels(labels + (('le', le),)), count))
+    L.append('%s_sum%s %s' % (name, _metric_labels(labels), hist['sum']))
+    L.append('%s_count%s %s' % (name, _metric_labels(labels), hist['count']))
+    return L
+
+
+@get('/metrics')
+async def metrics(request):
+    """
+    以Prometheus文本格式输出ORM连接池和语句执行的统计数据
+    """
+    data = orm.pool_metrics()
+    L = [
+        '# TYPE orm_pool_connections gauge',
+        '# TYPE orm_pool_maxsize gauge',
+        '# TYPE orm_pool_checkouts_total counter',
+        '# TYPE orm_pool_saturations_total counter',
+        '# TYPE orm_pool_recycled_total counter',
+        '# TYPE orm_pool_invalid_total counter',
+        '# TYPE orm_pool_aborted_total counter',
+        '# TYPE orm_pool_limit gauge',
+        '# TYPE orm_pool_limit_changes_total counter',
+        '# TYPE orm_pool_wait_seconds histogram',
+        '# TYPE orm_pool_hold_seconds histogram',
+    ]
+    for name, pool in data['pools'].items():
+        labels = (('pool', name),)
+        L.append('orm_pool_connections%s %s' % (_metric_labels(labels + (('state', 'used'),)), pool['used']))
+        L.append('orm_pool_connections%s %s' % (_metric_labels(labels + (('state', 'free'),)), pool['free']))
+        L.append('orm_pool_maxsize%s %s' % (_metric_labels(labels), pool['maxsize']))
+        L.append('orm_pool_checkouts_total%s %s' % (_metric_labels(labels), pool['checkouts']))
+        L.append('orm_pool_saturations_total%s %s' % (_metric_labels(labels), pool['saturations']))
+        L.append('orm_pool_recycled_total%s %s' % (_metric_labels(labels), pool['recycled']))
+        L.append('orm_pool_invalid_total%s %s' % (_metric_labels(labels), pool['invalid']))
+        L.append('orm_pool_aborted_total%s %s' % (_metric_labels(labels), pool['aborted']))
+        limit = pool['limit']
+        if limit is not None:
+            # 自适应连接数上限的当前值和AIMD调整次数
+            L.append('orm_pool_limit%s %s' % (_metric_labels(labels), limit['limit']))
+            L.append('orm_pool_limit_changes_total%s %s'
+                     % (_metric_labels(labels + (('direction', 'increase'),)), limit['increases']))
+            L.append('orm_pool_limit_changes_total%s %s'
+                     % (_metric_labels(labels + (('direction', 'decrease'),)), limit['decreases']))
+        L.extend(_histogram_lines('orm_pool_wait_seconds', pool['wait'], labels))
+        L.extend(_histogram_lines('orm_pool_hold_seconds', pool['hold'], labels))
+    L.append('# TYPE orm_query_seconds histogram')
+    L.extend(_histogram_lines('orm_query_seconds', data['queries']))
+    r = web.Response(body=('\n'.join(L) + '\n').encode('utf-8'))
+    r.content_type = 'text/plain'
+    r.charset = 'utf-8'
+    return r
+
+
+@get('/manage/indexes')
+async def manage_indexes(request):
+    """
+    对ORM执行过的语句执行EXPLAIN，列出全表扫描和filesort
+    """
+    check_admin(request)
+    return dict(problems=await orm.index_report())
+
+
+@get('/manage/stats/statements')
+async def manage_statement_stats(request, *, sort='total', limit=None):
+    """
+    按语句指纹聚合的执行统计，找出占用数据库时间最多的查询
+    """
+    check_admin(request)
+    try:
+        limit = int(limit) if limit else None
+    except ValueError:
+        raise APIValueError('limit', 'Invalid limit value: %s' % limit)
+    try:
+        return orm.statement_stats(sort, limit)
+    except ValueError as e:
+        raise APIValueError('sort', str(e))
+
+
+@post('/manage/stats/statements/reset')
+async def manage_reset_statement_stats(request):
+    check_admin(request)
+    orm.reset_statement_stats()
+    return dict(reset=True)
+
+
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
 _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
 
@@ -167,21 +282,26 @@ async def api_register_user(*, email, name, passwd):
     """ 
     注册请求
     """
-    if not name or not name.strip():
+    # 长度与users表的varchar(50)一致，超长的值不能写入数据库
+    if not name or not name.strip() or len(name.strip()) > 50:
         raise APIValueError('name')
-    if not email or not _RE_EMAIL.match(email):
+    if not email or len(email) > 50 or not _RE_EMAIL.match(email):
         raise APIValueError('email')
     if not passwd or not _RE_SHA1.match(passwd):
         raise APIValueError('passwd')
-    users = await User.findAll('email=?', [email])
-    if len(users) > 0:
-        raise APIError('register:failed', 'email', 'Email is already in use.')
     uid = next_id()
     sha1_passwd = '%s:%s' % (uid, passwd)
     # sha1加密 hashlib.sha1('xxx').hexdigest()
     user = User(id=uid, name=name.strip(), email=email, passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(),
                 image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
-    await user.save()
+    # 邮箱的唯一性由idx_email保证，插入与已有邮箱冲突时才报告已被使用；
+    # 不使用INSERT IGNORE，MySQL会把它同时用于截断超长值、忽略NOT NULL等错误
+    try:
+        await user.save()
+    except Exception as e:
+        if not User.isDuplicate(e, 'idx_email'):
+            raise
+        raise APIError('register:failed', 'email', 'Email is already in use.')
     # make session cookie:
     r = web.Response()
     # 有效期定为10min
@@ -202,10 +322,9 @@ async def authenticate(*, email, passwd):
     if not passwd:
         raise APIValueError('passwd', 'Invaild password.')
 
-    users = await User.findAll('email=?', [email])
-    if len(users) == 0:
+    user = await User.query().where(email=email).first()
+    if user is None:
         raise APIValueError('email', 'Email not exist.')
-    user = users[0]
     # check passwd
     sha1 = hashlib.sha1()
     sha1.update(user.id.encode('utf-8'))
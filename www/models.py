@@ -5,7 +5,7 @@ Models for user, blog, comment.
 """
 import time, uuid
 
-from www.orm import Model, StringField, BooleanField, FloatField, TextField
+from www.orm import Model, StringField, BooleanField, FloatField, TextField, BelongsTo, HasMany
 
 
 __author__ = 'fjzhang'
@@ -18,6 +18,11 @@ def next_id():
 class User(Model):
     """ 用户数据模型 """
     __table__ = 'users'
+    # 每个请求都会通过cookie2user按主键查找用户
+    __cache__ = dict(size=10000, ttl=60)
+    # 并发请求的User.find合并为一次IN查询
+    __batch_find__ = dict(window=0, size=100)
+    __indexes__ = [dict(name='idx_email', fields=['email'], unique=True), 'created_at']
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     email = StringField(ddl='varchar(50)')
@@ -31,25 +36,41 @@ class User(Model):
 class Blog(Model):
     """ 博客数据模型 """
     __table__ = 'blogs'
+    __cache__ = dict(size=10000, ttl=60)
+    # 分页需要的总数在没有写入时不必每次执行COUNT
+    __count_cache__ = dict(size=1000, ttl=60)
+    __indexes__ = ['user_id', 'created_at']
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    title = StringField(ddl='varchar(50)')
+    name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
+    content = TextField(ddl='mediumtext')
     created_at = FloatField(default=time.time)
 
+    # 通过prefetch批量加载：Blog.findAll(prefetch=['comments'])
+    user = BelongsTo('User', 'user_id')
+    comments = HasMany('Comment', 'blog_id', order_by='created_at')
+
 
 class Comment(Model):
     """ 评论数据模型 """
     __table__ = 'comments'
+    __count_cache__ = dict(size=1000, ttl=60)
+    # 博客页面按blog_id查询评论并按created_at排序
+    __indexes__ = [('blog_id', 'created_at'), 'user_id', 'created_at']
+    # 热门博客下同时提交的评论合并为一条多行INSERT
+    __coalesce__ = dict(window=0.002, size=100)
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    content = TextField()
+    content = TextField(ddl='mediumtext')
     created_at = FloatField(default=time.time)
+
+    blog = BelongsTo('Blog', 'blog_id')
+    user = BelongsTo('User', 'user_id')
@@ -5,7 +5,8 @@ __author__ = 'fjzhang'
 
 建立一个web访问的ORM，每一个web请求被连接之后都要接入数据库进行操作。
 在web框架中，采用基于asyncio的aiohttp，这是基于协程的异步模型，
-所以整个ORM的框架采用异步操作，采用aiomysql作为数据库的异步IO驱动。
+所以整个ORM的框架采用异步操作，默认采用aiomysql作为数据库的异步IO驱动，
+也可以通过www.backends中的SQLite后端使用同样的Model API。
 
 思路分析：
 Ⅰ. 首先需要建议一个全局的连接池，使得每一个HTTP请求都能从连接池中取得连接，
@@ -31,62 +32,887 @@ __author__ = 'fjzhang'
     实现数据库操作的所有方法，并定义为class方法，所有继承自Model都具有数据库操作方法。
 """
 
-import asyncio, logging
+import asyncio, base64, collections, contextlib, contextvars, hashlib, itertools, json, logging, random, re, time, weakref
 
-import aiomysql
+from www import backends
 
 
-# 打印SQL语句
-def log(sql, args=()):
-    logging.info('SQL: %s' % sql)
+# 预编译后的SQL语句：驱动可直接执行的SQL文本、期望的参数个数、语句指纹、是否可以EXPLAIN（SELECT/UPDATE/DELETE）
+Statement = collections.namedtuple('Statement', ['sql', 'nargs', 'fingerprint', 'explainable'])
+
+_RE_SPACES = re.compile(r'\s+')
+_RE_ARGS_LIST = re.compile(r'\?(\s*,\s*\?)+')
+
+
+def compile_sql(sql, placeholder='%s'):
+    """
+    将ORM使用的SQL模板编译为Statement
+    SQL语句的占位符是?，MySQL的占位符是%s，SQLite的占位符就是?
+    指纹由规范化后的模板计算：合并空白、统一小写、将(?, ?, ...)折叠为(?+)，
+    因此同一形态的语句（例如参数个数不同的IN列表）拥有相同的指纹
+    :param sql: 使用?作为占位符的SQL模板
+    :return: Statement
+    """
+    normalized = _RE_ARGS_LIST.sub('?+', _RE_SPACES.sub(' ', sql.strip()).lower())
+    fingerprint = hashlib.md5(normalized.encode('utf-8')).hexdigest()[:16]
+    driver_sql = sql if placeholder == '?' else sql.replace('?', placeholder)
+    return Statement(driver_sql, sql.count('?'), fingerprint, normalized.startswith(('select', 'update', 'delete')))
+
+
+class StatementCache(object):
+    """
+    以SQL模板为键的有界LRU语句缓存
+    ModelMetaclass生成的__select__、__insert__等模板是固定的，
+    重复执行时直接命中缓存，跳过占位符替换和指纹计算等字符串操作
+    """
+
+    def __init__(self, maxsize=512, placeholder='%s'):
+        self.maxsize = maxsize
+        self.placeholder = placeholder
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+
+    def get(self, sql):
+        stmt = self._cache.get(sql)
+        if stmt is not None:
+            self.hits += 1
+            self._cache.move_to_end(sql)
+            return stmt
+        self.misses += 1
+        stmt = compile_sql(sql, self.placeholder)
+        self._cache[sql] = stmt
+        if len(self._cache) > self.maxsize:
+            # 淘汰最久未使用的语句
+            self._cache.popitem(last=False)
+        return stmt
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self._cache), maxsize=self.maxsize)
+
+
+# 全局的语句缓存
+_statements = StatementCache()
+
+
+def statement_cache_info():
+    """ 返回语句缓存的命中/未命中计数和当前容量 """
+    return _statements.info()
+
+
+# ORM执行过的不同SELECT/UPDATE/DELETE语句（按指纹），只在第一次出现时保存模板和参数，
+# 供index_report()执行EXPLAIN；之后重复的查询只做一次字典查找，也不会在内存中持续保留每次的密码、邮箱等参数
+# INSERT不需要EXPLAIN，不记录
+_issued = {}
+_ISSUED_MAXSIZE = 1000
+
+
+def _prepare(sql, args):
+    stmt = _statements.get(sql)
+    if args is None:
+        args = ()
+    if len(args) != stmt.nargs:
+        raise ValueError('SQL expects %d args but got %d: %s' % (stmt.nargs, len(args), sql))
+    if stmt.explainable and stmt.fingerprint not in _issued:
+        if len(_issued) >= _ISSUED_MAXSIZE:
+            # 淘汰最早记录的语句
+            del _issued[next(iter(_issued))]
+        _issued[stmt.fingerprint] = (sql, tuple(args))
+    return stmt, args
+
+
+class Histogram(object):
+    """ 固定桶的累计直方图（单位：秒），格式与Prometheus的histogram一致 """
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def info(self):
+        cumulative = list(itertools.accumulate(self.counts))
+        return dict(count=self.count, sum=self.sum,
+                    buckets=list(zip(self.buckets + (float('inf'),), cumulative)))
+
+
+class PoolMetrics(object):
+    """
+    单个连接池的统计：取连接的等待时间、连接的持有时间、取连接次数，
+    以及饱和事件（取连接时没有空闲连接且连接数已达maxsize，只能排队等待）、
+    因超过最长使用时间被回收的连接数、取出时校验失败被丢弃的连接数，
+    和因超过截止时间或请求被取消而终止语句并关闭的连接数
+    """
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.checkouts = 0
+        self.saturations = 0
+        self.recycled = 0
+        self.invalid = 0
+        self.aborted = 0
+        self.wait = Histogram()
+        self.hold = Histogram()
+        # 自适应的连接数上限，由create_pool(adaptive=dict(...))设置
+        self.limiter = None
+
+    def info(self):
+        pool = self.pool
+        return dict(size=pool.size, free=pool.freesize, used=pool.size - pool.freesize,
+                    minsize=pool.minsize, maxsize=pool.maxsize,
+                    checkouts=self.checkouts, saturations=self.saturations,
+                    recycled=self.recycled, invalid=self.invalid, aborted=self.aborted,
+                    wait=self.wait.info(), hold=self.hold.info(),
+                    limit=self.limiter.info() if self.limiter is not None else None)
+
+
+class AdaptiveLimit(object):
+    """
+    用AIMD（加性增、乘性减）调整连接池的有效连接数上限，上限在[minsize, maxsize]之间：
+    每interval秒根据这段时间内取连接的平均等待时间和语句的平均耗时调整一次
+    - 语句平均耗时超过latency：数据库已经过载，上限乘以backoff
+    - 否则取连接的平均等待时间超过wait：请求在排队，上限加1
+    超过上限的取连接请求按先来先服务的顺序等待
+    """
+
+    def __init__(self, name, minsize, maxsize, initial=None, wait=0.01, latency=0.1, interval=1.0, backoff=0.75):
+        if not 1 <= minsize <= maxsize:
+            raise ValueError('Invalid adaptive limit bounds: %s, %s' % (minsize, maxsize))
+        if not 0 < backoff < 1:
+            raise ValueError('Invalid adaptive limit backoff: %s' % backoff)
+        self.name = name
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.limit = min(maxsize, max(minsize, initial if initial is not None else maxsize // 2))
+        self.wait_target = wait
+        self.latency_target = latency
+        self.interval = interval
+        self.backoff = backoff
+        self.in_use = 0
+        self.increases = 0
+        self.decreases = 0
+        self._waiters = collections.deque()
+        self._window = time.monotonic()
+        self._wait = [0.0, 0]
+        self._latency = [0.0, 0]
+
+    @property
+    def saturated(self):
+        return self.in_use >= self.limit
+
+    async def acquire(self):
+        if self.in_use < self.limit and not self._waiters:
+            self.in_use += 1
+            return
+        fut = asyncio.get_event_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                # 已经分配到名额之后才被取消，把名额交给下一个等待者
+                self.release()
+            elif fut in self._waiters:
+                # 被取消的future可能已经被_wake()取出
+                self._waiters.remove(fut)
+            raise
+
+    def release(self):
+        self.in_use -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.in_use < self.limit:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self.in_use += 1
+                fut.set_result(None)
+
+    def observe_wait(self, elapsed):
+        self._wait[0] += elapsed
+        self._wait[1] += 1
+        self._maybe_adjust()
+
+    def observe_latency(self, elapsed):
+        self._latency[0] += elapsed
+        self._latency[1] += 1
+        self._maybe_adjust()
+
+    def _maybe_adjust(self):
+        now = time.monotonic()
+        if now - self._window < self.interval:
+            return
+        wait = self._wait[0] / self._wait[1] if self._wait[1] else 0.0
+        latency = self._latency[0] / self._latency[1] if self._latency[1] else 0.0
+        self._window = now
+        self._wait = [0.0, 0]
+        self._latency = [0.0, 0]
+        old = self.limit
+        if latency > self.latency_target:
+            self.limit = max(self.minsize, int(self.limit * self.backoff))
+            if self.limit != old:
+                self.decreases += 1
+                logging.info('connection pool %s: avg query latency %.3fs > %.3fs, limit %s -> %s',
+                             self.name, latency, self.latency_target, old, self.limit)
+        elif wait > self.wait_target and self.limit < self.maxsize:
+            self.limit += 1
+            self.increases += 1
+            logging.info('connection pool %s: avg checkout wait %.3fs > %.3fs, limit %s -> %s',
+                         self.name, wait, self.wait_target, old, self.limit)
+            self._wake()
+
+    def info(self):
+        return dict(limit=self.limit, in_use=self.in_use, waiting=len(self._waiters),
+                    minsize=self.minsize, maxsize=self.maxsize,
+                    increases=self.increases, decreases=self.decreases)
+
+
+class PoolHealth(object):
+    """
+    连接池中连接的健康管理，避免冷启动和失效的空闲连接造成的延迟尖刺
+    - warm: 启动时预先建立的连接数，在开始处理请求之前完成连接握手
+    - keepalive: 后台保活的间隔（秒），定期ping空闲超过该时间的连接，避免被服务器的wait_timeout断开，
+      应小于wait_timeout的一半；None表示不保活
+    - max_age: 连接的最长使用时间（秒），超过后在取出时关闭并重新建立；None表示不限制
+    - validate_idle: 取出时空闲超过该时间（秒）的连接先ping一次，失败则丢弃并重新取连接；None表示不校验
+    连接的创建时间以ORM第一次见到该连接的时间为准
+    """
+
+    def __init__(self, warm=0, keepalive=None, max_age=None, validate_idle=30.0):
+        self.warm = warm
+        self.keepalive = keepalive
+        self.max_age = max_age
+        self.validate_idle = validate_idle
+        # 连接 -> [第一次见到的时间, 最近一次归还的时间]
+        self._conns = weakref.WeakKeyDictionary()
+        self._task = None
+
+    def _discard(self, pool, conn):
+        conn.close()
+        return pool.release(conn)
+
+    async def acquire(self, pool, metrics, idle=None):
+        """ 从连接池取得一个可用的连接：超龄的连接被回收，空闲超过idle秒（默认validate_idle）的连接先ping校验 """
+        if idle is None:
+            idle = self.validate_idle
+        while True:
+            conn = await pool.acquire()
+            try:
+                if await self._check(pool, conn, metrics, idle):
+                    return conn
+            except BaseException:
+                # 校验期间被取消或超过截止时间：连接已经取出，关闭并归还，不能泄漏
+                if not conn.closed:
+                    conn.close()
+                    pool.release(conn)
+                raise
+
+    async def _check(self, pool, conn, metrics, idle):
+        """ 检查刚取出的连接，不可用的连接被关闭并归还连接池，返回连接是否可用 """
+        now = time.monotonic()
+        state = self._conns.get(conn)
+        if state is None:
+            # 新建立的连接不需要校验
+            self._conns[conn] = [now, now]
+            return True
+        if self.max_age is not None and now - state[0] > self.max_age:
+            metrics.recycled += 1
+            logging.debug('connection pool %s: recycle connection after %.0fs', metrics.name, now - state[0])
+            await self._discard(pool, conn)
+            return False
+        if idle is not None and now - state[1] > idle:
+            try:
+                await conn.ping(False)
+            except Exception as e:
+                metrics.invalid += 1
+                logging.info('connection pool %s: discard stale connection: %s', metrics.name, e)
+                await self._discard(pool, conn)
+                return False
+        return True
+
+    def released(self, conn):
+        state = self._conns.get(conn)
+        if state is not None:
+            state[1] = time.monotonic()
+
+    async def warm_up(self, pool, metrics):
+        """ 同时取出warm个连接再归还，使连接池在处理请求之前就持有足够的已建立连接 """
+        n = min(self.warm, pool.maxsize)
+        if n <= 0:
+            return
+        start = time.monotonic()
+        results = await asyncio.gather(*[self.acquire(pool, metrics) for _ in range(n)], return_exceptions=True)
+        for conn in results:
+            if not isinstance(conn, BaseException):
+                self.released(conn)
+                await pool.release(conn)
+        errors = [e for e in results if isinstance(e, BaseException)]
+        if errors:
+            raise errors[0]
+        logging.info('connection pool %s: warmed up %s connections in %.3fs',
+                     metrics.name, pool.size, time.monotonic() - start)
+
+    def start(self, pools):
+        """ 启动后台保活任务，pools为[(连接池, PoolMetrics)] """
+        if self.keepalive is not None:
+            self._task = asyncio.ensure_future(self._keepalive(pools))
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _keepalive(self, pools):
+        while True:
+            await asyncio.sleep(self.keepalive)
+            for pool, metrics in pools:
+                try:
+                    # 空闲连接按先进先出的顺序取出，依次取当前空闲连接数次即可检查所有空闲连接
+                    for _ in range(pool.freesize):
+                        if pool.freesize == 0:
+                            break
+                        conn = await self.acquire(pool, metrics, self.keepalive)
+                        self.released(conn)
+                        await pool.release(conn)
+                except Exception as e:
+                    logging.warning('connection pool %s keepalive failed: %s', metrics.name, e)
+
+
+# 所有SQL语句的执行耗时
+_query_latency = Histogram()
+
+
+class SlowQueryLog(object):
+    """
+    慢查询日志
+    执行时间超过threshold秒的语句按sample的比例抽样，以JSON的形式写入名为'orm.slow'的logger，
+    记录语句指纹、SQL模板、脱敏后的参数、耗时、行数和发起查询的handler；
+    explain为True时在后台用另一个连接对SELECT/UPDATE/DELETE执行EXPLAIN，把执行计划一并写入日志
+    threshold为None时关闭慢查询日志
+    """
+
+    def __init__(self, threshold=0.5, sample=1.0, explain=True, redact=True):
+        self.threshold = threshold
+        self.sample = sample
+        self.explain = explain
+        self.redact = redact
+        self.logger = logging.getLogger('orm.slow')
+
+    def configure(self, **kw):
+        for k, v in kw.items():
+            if not hasattr(self, k) or k == 'logger':
+                raise ValueError('Invalid slow log option: %s' % k)
+            setattr(self, k, v)
+
+    def _redact(self, args):
+        if not self.redact:
+            return list(args)
+        # 只保留参数的类型和长度，不记录具体的值
+        return ['<%s:%s>' % (type(a).__name__, len(a)) if isinstance(a, (str, bytes)) else '<%s>' % type(a).__name__
+                for a in args]
+
+    def record(self, stmt, sql, args, elapsed, rows):
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return
+        verb = sql.lstrip()[:7].lower()
+        if verb == 'explain':
+            # 慢查询日志自己发出的EXPLAIN不再记录
+            return
+        entry = dict(fingerprint=stmt.fingerprint, sql=sql, args=self._redact(args), ms=round(elapsed * 1000, 3),
+                     rows=rows, handler=_handler.get())
+        if self.explain and verb.startswith(('select', 'update', 'delete')):
+            # EXPLAIN在空的上下文中执行：不使用调用者的事务连接，也不占用请求的连接预算
+            contextvars.Context().run(asyncio.ensure_future, self._explain(entry, sql, args))
+        else:
+            self._write(entry)
+
+    async def _explain(self, entry, sql, args):
+        try:
+            entry['plan'] = [dict(r) for r in await select(_backend.explain_sql(sql), args)]
+        except Exception as e:
+            entry['plan_error'] = str(e)
+        self._write(entry)
+
+    def _write(self, entry):
+        self.logger.warning(json.dumps(entry, ensure_ascii=False, default=str))
+
+
+_slow_log = SlowQueryLog()
+
+# 当前请求的handler名称，由web中间件通过request_context()设置，写入慢查询日志
+_handler = contextvars.ContextVar('orm_handler', default=None)
+
+
+@contextlib.contextmanager
+def request_context(handler):
+    """ 标记当前上下文中的查询由哪个handler发起 """
+    token = _handler.set(handler)
+    try:
+        yield
+    finally:
+        _handler.reset(token)
+
+
+class StatementStats(object):
+    """
+    按语句指纹聚合的执行统计（类似pg_stat_statements）：
+    调用次数、总耗时、平均耗时、p95耗时（基于最近samples次执行）、返回/影响的总行数
+    最多统计maxsize种语句，超出后新的语句只计入dropped
+    """
+
+    def __init__(self, maxsize=5000, samples=1000):
+        self.maxsize = maxsize
+        self.samples = samples
+        self.dropped = 0
+        self.since = time.time()
+        self._stats = dict()
+
+    def record(self, stmt, sql, elapsed, rows):
+        entry = self._stats.get(stmt.fingerprint)
+        if entry is None:
+            if len(self._stats) >= self.maxsize:
+                self.dropped += 1
+                return
+            # [SQL模板, 调用次数, 总耗时, 总行数, 最近的耗时样本]
+            entry = [sql, 0, 0.0, 0, collections.deque(maxlen=self.samples)]
+            self._stats[stmt.fingerprint] = entry
+        entry[1] += 1
+        entry[2] += elapsed
+        if rows is not None and rows > 0:
+            entry[3] += rows
+        entry[4].append(elapsed)
+
+    def reset(self):
+        self._stats.clear()
+        self.dropped = 0
+        self.since = time.time()
+
+    def info(self, sort='total', limit=None):
+        L = []
+        for fingerprint, (sql, calls, total, rows, samples) in list(self._stats.items()):
+            ordered = sorted(samples)
+            p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] if ordered else 0.0
+            L.append(dict(fingerprint=fingerprint, sql=sql, calls=calls, total_ms=total * 1000,
+                          mean_ms=total * 1000 / calls, p95_ms=p95 * 1000, rows=rows))
+        key = dict(total='total_ms', calls='calls', mean='mean_ms', p95='p95_ms', rows='rows').get(sort)
+        if key is None:
+            raise ValueError('Invalid sort value: %s' % sort)
+        L.sort(key=lambda e: e[key], reverse=True)
+        return L[:limit] if limit else L
+
+
+_statement_stats = StatementStats()
+
+
+def statement_stats(sort='total', limit=None):
+    """
+    返回按语句指纹聚合的执行统计，按sort（total/calls/mean/p95/rows）降序排列
+    :return: dict(since=开始统计的时间戳, dropped=未统计的执行次数, statements=[...])
+    """
+    return dict(since=_statement_stats.since, dropped=_statement_stats.dropped,
+                statements=_statement_stats.info(sort, limit))
+
+
+def reset_statement_stats():
+    """ 清空语句统计，重新开始统计 """
+    _statement_stats.reset()
+
+
+def _observe(stmt, sql, args, elapsed, rows, conn=None):
+    """ 记录一条语句的执行耗时，超过阈值时写入慢查询日志，conn为执行语句的连接 """
+    _query_latency.observe(elapsed)
+    metrics = _owners.get(conn) if conn is not None else None
+    if metrics is not None and metrics.limiter is not None:
+        metrics.limiter.observe_latency(elapsed)
+    _statement_stats.record(stmt, sql, elapsed, rows)
+    threshold = _slow_log.threshold
+    if threshold is not None and elapsed >= threshold:
+        _slow_log.record(stmt, sql, args, elapsed, rows)
+
+
+def pool_metrics():
+    """
+    返回连接池和语句执行的统计数据
+    :return: dict(pools={池名称: PoolMetrics.info()}, queries=语句耗时直方图)
+    """
+    global __pool, __replicas
+    pools = collections.OrderedDict()
+    if __pool is not None:
+        pools[__primary_metrics.name] = __primary_metrics.info()
+    if __replicas is not None:
+        for m in __replicas.metrics:
+            pools[m.name] = m.info()
+    return dict(pools=pools, queries=_query_latency.info())
+
+
+class ReplicaSet(object):
+    """
+    只读副本的连接池集合，为每条只读查询选择一个副本
+    - round_robin: 依次轮流使用每个副本
+    - latency: 记录每个副本查询耗时的指数移动平均(EWMA)，按EWMA×(正在使用的连接数+1)选择负载最轻的副本
+    """
+
+    def __init__(self, pools, policy='round_robin', alpha=0.2):
+        if policy not in ('round_robin', 'latency'):
+            raise ValueError('Invalid replica policy: %s' % policy)
+        self.pools = pools
+        self.metrics = [PoolMetrics('replica%d' % i, pool) for i, pool in enumerate(pools)]
+        self.policy = policy
+        self.alpha = alpha
+        self.latency = [0.0] * len(pools)
+        self._rr = itertools.cycle(range(len(pools)))
+
+    def choose(self):
+        if self.policy == 'latency':
+            def load(i):
+                pool = self.pools[i]
+                return self.latency[i] * (pool.size - pool.freesize + 1)
+            # 从轮询位置开始比较，负载相同时各副本轮流被选中
+            first = next(self._rr)
+            order = [(first + k) % len(self.pools) for k in range(len(self.pools))]
+            return min(order, key=load)
+        return next(self._rr)
+
+    def observe(self, index, elapsed):
+        self.latency[index] += self.alpha * (elapsed - self.latency[index])
+
+
+# 全局变量__pool用于存储主库的连接池，__replicas为只读副本的ReplicaSet
+__pool = None
+__primary_metrics = None
+__replicas = None
+
+# 为True时当前上下文的只读查询也发往主库（read-your-writes）
+_use_primary = contextvars.ContextVar('orm_use_primary', default=False)
+# 当前上下文所在的事务
+_current_tx = contextvars.ContextVar('orm_transaction', default=None)
+# 当前上下文可同时持有的连接数预算，由外到内的asyncio.Semaphore元组
+_budget = contextvars.ContextVar('orm_budget', default=())
+# 当前上下文中数据库操作的截止时间（time.monotonic()），None表示不限制
+_deadline = contextvars.ContextVar('orm_deadline', default=None)
+# 连接 -> 所属连接池的PoolMetrics，用于把语句耗时计入该连接池的自适应上限
+_owners = weakref.WeakKeyDictionary()
+
+
+# 当前使用的数据库后端，由create_pool设置
+_backend = None
+# 连接的预热、保活和校验，由create_pool设置
+_health = PoolHealth()
+
+
+async def _create_pool(loop, kw):
+    return await _backend.create_pool(loop, kw)
 
 
 # 创建全局的连接池，每个HTTP请求都能从池中获得数据库连接
 async def create_pool(loop, **kw):
+    """
+    创建主库连接池，以及可选的只读副本连接池
+    replicas是副本连接参数的列表，例如[dict(host='10.0.0.2'), dict(port=3307)]，
+    未指定的参数（用户名、密码、库名等）沿用主库的配置，因此可以用本机不同端口上的多个MySQL实例测试读写分离
+    :param backend: 数据库后端，'mysql'（默认）或'sqlite'，SQLite使用database参数指定数据库文件
+    :param replicas: 只读副本列表
+    :param replica_policy: 副本选择策略，'round_robin'或'latency'
+    :param warm: 启动时预先建立的连接数
+    :param keepalive: 空闲连接的保活间隔（秒）
+    :param max_age: 连接的最长使用时间（秒）
+    :param validate_idle: 取出时需要ping校验的空闲时间（秒），默认30
+    参见PoolHealth
+    :param adaptive: 自适应连接数上限的配置，例如dict(minsize=2, wait=0.01, latency=0.1)，
+        上限不超过maxsize，参见AdaptiveLimit
+    """
     logging.info('create database connection pool...')
-    # 全局变量__pool用于存储整个连接池
-    global __pool
-    __pool = await aiomysql.create_pool(
-        # **kw参数可以包含所有连接需要用到的关键字参数
-        # 默认本机IP
-        host=kw.get('host', 'localhost'),
-        port=kw.get('port', 3306),
-        user=kw['user'],
-        password=kw['password'],
-        db=kw['db'],
-        charset=kw.get('charset', 'utf8'),  # 给自己挖了一个大坑：utf-8，报错根本提示不到这
-        autocommit=kw.get('autocommit', True),
-        maxsize=kw.get('maxsize', 10),  # 默认最大连接数为10
-        minsize=kw.get('minsize', 1),
-        loop=loop  # 接受一个event_loop实例
-    )
+    global __pool, __primary_metrics, __replicas, _backend, _health
+    _backend = backends.get_backend(kw.pop('backend', 'mysql'))
+    if _statements.placeholder != _backend.placeholder:
+        # 缓存中的语句是为另一种占位符编译的
+        _statements.clear()
+        _statements.placeholder = _backend.placeholder
+    replicas = kw.pop('replicas', None) or []
+    policy = kw.pop('replica_policy', 'round_robin')
+    __pool = await _create_pool(loop, kw)
+    __primary_metrics = PoolMetrics('primary', __pool)
+    if replicas:
+        logging.info('create %s read replica connection pools (%s)...' % (len(replicas), policy))
+        pools = []
+        for replica in replicas:
+            options = dict(kw)
+            options.update(replica)
+            pools.append(await _create_pool(loop, options))
+        __replicas = ReplicaSet(pools, policy)
+    else:
+        __replicas = None
+    _health.stop()
+    _health = PoolHealth(warm=kw.get('warm', 0), keepalive=kw.get('keepalive'),
+                         max_age=kw.get('max_age'), validate_idle=kw.get('validate_idle', 30.0))
+    pools = [(__pool, __primary_metrics)]
+    if __replicas is not None:
+        pools.extend(zip(__replicas.pools, __replicas.metrics))
+    if kw.get('adaptive') is not None:
+        options = dict(kw['adaptive'])
+        minsize = options.pop('minsize', None)
+        for pool, metrics in pools:
+            metrics.limiter = AdaptiveLimit(metrics.name, minsize or max(pool.minsize, 1), pool.maxsize, **options)
+    # 在应用开始处理请求之前完成预热
+    for pool, metrics in pools:
+        await _health.warm_up(pool, metrics)
+    _health.start(pools)
+    if 'statement_cache_size' in kw:
+        _statements.maxsize = kw['statement_cache_size']
+    # 慢查询日志的配置，例如slow_log=dict(threshold=0.2, sample=0.1)
+    if 'slow_log' in kw:
+        _slow_log.configure(**kw['slow_log'])
 
 
 async def destroy_pool():
-    global __pool
-    if __pool is not None:
-        __pool.close()
-        await __pool.wait_closed()
+    global __pool, __primary_metrics, __replicas
+    _health.stop()
+    pools = [__pool] if __pool is not None else []
+    if __replicas is not None:
+        pools.extend(__replicas.pools)
+    for pool in pools:
+        pool.close()
+        await pool.wait_closed()
+    __pool = None
+    __primary_metrics = None
+    __replicas = None
+
+
+@contextlib.contextmanager
+def primary():
+    """
+    read-your-writes：在此上下文中的只读查询也发往主库
+    with orm.primary():
+        user = await User.find(uid)
+    """
+    token = _use_primary.set(True)
+    try:
+        yield
+    finally:
+        _use_primary.reset(token)
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """ 数据库操作超过了当前请求的截止时间 """
+    pass
+
+
+@contextlib.contextmanager
+def deadline(timeout):
+    """
+    限制当前上下文（通常是一个HTTP请求）中数据库操作的截止时间，timeout为秒数
+    取连接、执行语句和读取结果都不会超过截止时间，超时抛出DeadlineExceeded，
+    正在执行的语句在服务器端被终止，连接被关闭而不是归还连接池
+    嵌套使用时取较早的截止时间
+    """
+    when = time.monotonic() + timeout
+    current = _deadline.get()
+    token = _deadline.set(when if current is None else min(current, when))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def _remaining():
+    """ 当前截止时间的剩余秒数，未设置时返回None，已经超时时抛出DeadlineExceeded """
+    when = _deadline.get()
+    if when is None:
+        return None
+    remaining = when - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded('Database deadline exceeded')
+    return remaining
+
+
+async def _bounded(aw):
+    """ 在当前上下文的截止时间内等待aw """
+    try:
+        remaining = _remaining()
+    except DeadlineExceeded:
+        if asyncio.iscoroutine(aw):
+            aw.close()
+        elif asyncio.isfuture(aw):
+            aw.cancel()
+        raise
+    if remaining is None:
+        return await aw
+    try:
+        return await asyncio.wait_for(aw, remaining)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded('Database deadline exceeded') from None
+
+
+def _aborted(exc):
+    """ 连接上的操作被取消或超时，连接的协议状态不确定，不能再使用 """
+    return isinstance(exc, (asyncio.CancelledError, DeadlineExceeded))
+
+
+def _abort(pool, conn, metrics):
+    """ 在服务器端终止连接上可能正在执行的语句并关闭连接 """
+    metrics.aborted += 1
+    logging.info('connection pool %s: abort connection after deadline or cancellation', metrics.name)
+    kill = None
+    try:
+        kill = _backend.interrupt(pool, conn)
+    except Exception as e:
+        logging.warning('interrupt statement failed: %s', e)
+    conn.close()
+    if kill is not None:
+        # 在空的上下文中执行：不受已经超时的截止时间和请求的连接预算限制
+        contextvars.Context().run(asyncio.ensure_future, _kill(kill))
+
+
+async def _kill(kill):
+    try:
+        await asyncio.wait_for(kill, 5)
+    except Exception as e:
+        logging.warning('kill statement failed: %s', e)
+
+
+@contextlib.asynccontextmanager
+async def _checkout(pool, metrics):
+    """
+    从连接池取得连接并记录等待时间、持有时间和饱和事件
+    使用连接期间被取消或超过截止时间时，终止语句并关闭连接
+    """
+    limiter = metrics.limiter
+    if (pool.freesize == 0 and pool.size >= pool.maxsize) or (limiter is not None and limiter.saturated):
+        metrics.saturations += 1
+        logging.debug('connection pool %s saturated: %s connections in use', metrics.name, pool.size)
+    start = time.monotonic()
+    if limiter is not None:
+        await _bounded(limiter.acquire())
+    try:
+        conn = await _bounded(_health.acquire(pool, metrics))
+    except BaseException:
+        if limiter is not None:
+            limiter.release()
+        raise
+    acquired = time.monotonic()
+    metrics.wait.observe(acquired - start)
+    metrics.checkouts += 1
+    if limiter is not None:
+        limiter.observe_wait(acquired - start)
+    _owners[conn] = metrics
+    try:
+        yield conn
+    except BaseException as e:
+        if _aborted(e):
+            _abort(pool, conn, metrics)
+        raise
+    finally:
+        metrics.hold.observe(time.monotonic() - acquired)
+        _health.released(conn)
+        try:
+            await pool.release(conn)
+        finally:
+            if limiter is not None:
+                limiter.release()
+
+
+@contextlib.asynccontextmanager
+async def _connection(readonly=False):
+    """
+    从连接池取得一个连接，用完后归还
+    只读查询在配置了副本时默认路由到副本，写操作和primary()上下文中的查询始终使用主库
+    设置了connection_budget()时，当前请求同时持有的连接数不超过预算
+    """
+    tx = _current_tx.get()
+    if tx is not None:
+        # 事务中的所有语句都使用事务固定的连接
+        yield tx.conn
+        return
+    budgets = _budget.get()
+    acquired = []
+    try:
+        # 由外到内依次取得各层预算，顺序一致不会互相死锁
+        for budget in budgets:
+            await _bounded(budget.acquire())
+            acquired.append(budget)
+        global __pool, __primary_metrics, __replicas
+        replicas = __replicas
+        if not readonly or replicas is None or _use_primary.get():
+            async with _checkout(__pool, __primary_metrics) as conn:
+                yield conn
+            return
+        index = replicas.choose()
+        start = time.monotonic()
+        async with _checkout(replicas.pools[index], replicas.metrics[index]) as conn:
+            yield conn
+        replicas.observe(index, time.monotonic() - start)
+    finally:
+        for budget in reversed(acquired):
+            budget.release()
 
 
 # 封装SQL SELECT语句
-async def select(sql, args, size=None):
-    log(sql, args)
-    global __pool
-    async with __pool.get() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            # 执行SQL语句
-            # SQL语句的占位符是?，MySQL的占位符是%s
-            await cur.execute(sql.replace('?', '%s'), args or ())
+async def select(sql, args, size=None, as_dict=True):
+    stmt, args = _prepare(sql, args)
+    async with _connection(readonly=True) as conn:
+        # as_dict为False时每行返回tuple，供紧凑的行对象使用
+        start = time.monotonic()
+        async with conn.cursor(_backend.DictCursor if as_dict else _backend.Cursor) as cur:
+            # 执行预编译的SQL语句
+            await _bounded(cur.execute(stmt.sql, args))
             # 根据指定返回的size，返回查询的结果
             if size:
-                rs = await cur.fetchmany(size)  # 返回size条查询结果
+                rs = await _bounded(cur.fetchmany(size))  # 返回size条查询结果
             else:
-                rs = await cur.fetchall()  # 返回所有查询结果
-        logging.info('rows returned: %s' % len(rs))
+                rs = await _bounded(cur.fetchall())  # 返回所有查询结果
+        _observe(stmt, sql, args, time.monotonic() - start, len(rs), conn)
         return rs
 
 
+async def iterate(sql, args, chunk=500, as_dict=True):
+    """
+    封装流式SQL SELECT语句
+    使用不缓冲的服务器端游标(SSDictCursor)，每次取chunk行并yield，不会一次性把结果集读入内存
+    :param sql: SQL语句
+    :param args:
+    :param chunk: 每批读取的行数
+    :return: 异步生成器，每次产生一批查询结果
+    """
+    if chunk < 1:
+        raise ValueError('Invalid chunk value: %s' % chunk)
+    stmt, args = _prepare(sql, args)
+    async with _connection(readonly=True) as conn:
+        # 游标关闭时会读完剩余的结果，保证连接归还连接池时处于干净的状态
+        async with conn.cursor(_backend.SSDictCursor if as_dict else _backend.SSCursor) as cur:
+            # 流式查询只统计发出语句到服务器开始返回结果的时间，返回的行数在迭代结束（或提前退出）时一起记录
+            start = time.monotonic()
+            await _bounded(cur.execute(stmt.sql, args))
+            elapsed = time.monotonic() - start
+            rows = 0
+            try:
+                while True:
+                    rs = await _bounded(cur.fetchmany(chunk))
+                    if not rs:
+                        break
+                    rows += len(rs)
+                    yield rs
+            finally:
+                _observe(stmt, sql, args, elapsed, rows, conn)
+
+
 async def execute(sql, args, autocommit=True):
     """
     封装SQL INSERT，UPDATE，DELETE语句
@@ -97,28 +923,222 @@ async def execute(sql, args, autocommit=True):
     :param autocommit:
     :return:
     """
-    log(sql)
-    global __pool
-    async with __pool.get() as conn:
-        print(conn)
+    stmt, args = _prepare(sql, args)
+    # 在transaction()中执行时由事务统一提交
+    if _current_tx.get() is not None:
+        autocommit = True
+    async with _connection() as conn:
         if not autocommit:
             await conn.begin()
         try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                # SQL语句的占位符是?，MySQL的占位符是%s
-                await cur.execute(sql.replace('?', '%s'), args)
+            start = time.monotonic()
+            async with conn.cursor(_backend.DictCursor) as cur:
+                await _bounded(cur.execute(stmt.sql, args))
                 affected = cur.rowcount
+            _observe(stmt, sql, args, time.monotonic() - start, affected, conn)
             if not autocommit:
                 await conn.commit()
         except BaseException as e:
-            if not autocommit:
+            # 被取消或超时的连接会被关闭，未提交的事务由服务器回滚
+            if not autocommit and not _aborted(e):
                 await conn.rollback()
             raise
-        finally:
-            conn.close()
         return affected
 
 
+class Transaction(object):
+    """
+    固定一个主库连接的事务，通过orm.transaction()创建：
+
+    async with orm.transaction() as tx:
+        await user.save()
+        await blog.save()
+
+    作用域内所有的select/execute（包括Model的find/save/update/remove）都使用同一个连接，
+    退出时统一提交一次，发生异常时回滚。
+    嵌套使用时内层事务是一个SAVEPOINT，内层异常只回滚到该保存点。
+    同一个事务的连接不能被多个协程并发使用。
+    """
+
+    def __init__(self):
+        self.conn = None
+        self._root = None
+        self._savepoint = None
+        self._checkout = None
+        self._token = None
+        self._savepoints = 0
+        self._after_commit = []
+
+    @property
+    def nested(self):
+        return self._savepoint is not None
+
+    def after_commit(self, fn):
+        """ 注册在最外层事务提交成功之后执行的回调，例如让缓存失效 """
+        self._root._after_commit.append(fn)
+
+    async def _execute(self, sql):
+        async with self.conn.cursor() as cur:
+            await cur.execute(sql)
+
+    async def __aenter__(self):
+        parent = _current_tx.get()
+        if parent is not None:
+            self.conn = parent.conn
+            self._root = parent._root
+            self._root._savepoints += 1
+            self._savepoint = 'sp_%d' % self._root._savepoints
+            await self._execute('savepoint %s' % self._savepoint)
+        else:
+            self._root = self
+            self._checkout = _connection()
+            self.conn = await self._checkout.__aenter__()
+            try:
+                await self.conn.begin()
+            except BaseException as e:
+                await self._checkout.__aexit__(type(e), e, e.__traceback__)
+                raise
+        self._token = _current_tx.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        _current_tx.reset(self._token)
+        if exc is not None and _aborted(exc):
+            # 连接已不可用：跳过回滚，由_checkout关闭连接，服务器回滚未提交的事务
+            if self._checkout is not None:
+                await self._checkout.__aexit__(exc_type, exc, tb)
+            return False
+        if self._savepoint is not None:
+            if exc_type is None:
+                await self._execute('release savepoint %s' % self._savepoint)
+            else:
+                await self._execute('rollback to savepoint %s' % self._savepoint)
+            return False
+        failure = None
+        try:
+            if exc_type is None:
+                try:
+                    await self.conn.commit()
+                except BaseException as e:
+                    # 提交时被取消或超时的连接状态不确定，不再回滚
+                    if not _aborted(e):
+                        await self.conn.rollback()
+                    raise
+            else:
+                await self.conn.rollback()
+        except BaseException as e:
+            failure = e
+            raise
+        finally:
+            # 提交或回滚失败时把该异常交给_checkout，被取消或超时的连接会被关闭而不是归还连接池
+            if failure is not None:
+                await self._checkout.__aexit__(type(failure), failure, failure.__traceback__)
+            else:
+                await self._checkout.__aexit__(exc_type, exc, tb)
+        if exc_type is None:
+            for fn in self._after_commit:
+                fn()
+        return False
+
+
+def transaction():
+    """ 开始一个事务，已在事务中时开始一个嵌套的SAVEPOINT """
+    return Transaction()
+
+
+@contextlib.contextmanager
+def connection_budget(limit):
+    """
+    限制当前上下文（通常是一个HTTP请求）同时持有的连接数，避免单个页面的并发查询耗尽连接池
+    嵌套使用时内外两层的限制同时生效
+    同一个请求中先持有一个连接再发起另一个查询（例如在iterAll的循环中调用find）时，预算至少要为2
+    """
+    token = _budget.set(_budget.get() + (asyncio.Semaphore(limit),))
+    try:
+        yield
+    finally:
+        _budget.reset(token)
+
+
+class QueryGroup(object):
+    """
+    并发执行一组互不依赖的查询，每个查询使用各自的连接池连接
+    limit限制这一组查询同时持有的连接数（在请求的connection_budget之内）；
+    timings记录每个查询的名称和耗时（秒），包括等待连接的时间
+    在事务中时，所有查询共享事务的连接，因此依次执行
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.timings = []
+
+    @staticmethod
+    def _name(aw):
+        """ 查询的名称，例如'Blog.find'、'Comment.query().all'，取自协程的cls/self参数和方法名 """
+        frame = getattr(aw, 'cr_frame', None)
+        if frame is not None:
+            owner = frame.f_locals.get('cls', frame.f_locals.get('self'))
+            if isinstance(owner, Query):
+                return '%s.query().%s' % (owner._model.__name__, aw.__name__)
+            if isinstance(owner, type) and issubclass(owner, Model):
+                return '%s.%s' % (owner.__name__, aw.__name__)
+            if isinstance(owner, Model):
+                return '%s.%s' % (type(owner).__name__, aw.__name__)
+        return getattr(aw, '__qualname__', None) or repr(aw)
+
+    async def _timed(self, aw):
+        name = self._name(aw)
+        start = time.monotonic()
+        try:
+            return await aw
+        finally:
+            elapsed = time.monotonic() - start
+            self.timings.append((name, elapsed))
+            logging.debug('query %s finished in %.3fms', name, elapsed * 1000)
+
+    async def gather(self, *aws):
+        """ 执行所有查询，按传入的顺序返回结果，任一查询出错时抛出第一个异常 """
+        if _current_tx.get() is not None:
+            results = []
+            for i, aw in enumerate(aws):
+                try:
+                    results.append(await self._timed(aw))
+                except BaseException:
+                    # 出错之后的查询不再执行，关闭协程避免'coroutine was never awaited'警告
+                    for rest in aws[i + 1:]:
+                        if asyncio.iscoroutine(rest):
+                            rest.close()
+                    raise
+            return results
+        if self.limit is None:
+            return list(await asyncio.gather(*[self._timed(aw) for aw in aws]))
+        with connection_budget(self.limit):
+            return list(await asyncio.gather(*[self._timed(aw) for aw in aws]))
+
+
+async def gather(*aws, limit=None, group=None):
+    """
+    并发执行互不依赖的查询，页面的延迟约等于最慢的查询而不是所有查询之和：
+    blog, comments = await orm.gather(Blog.find(id), Comment.findAll('blog_id=?', [id]))
+    需要每个查询的耗时时传入group=QueryGroup()，结束后读取group.timings；
+    总耗时超过慢查询日志的阈值时在INFO级别记录各查询的耗时汇总，否则只在DEBUG级别记录
+    """
+    if group is None:
+        group = QueryGroup(limit)
+    elif limit is not None:
+        group.limit = limit
+    first, start = len(group.timings), time.monotonic()
+    try:
+        return await group.gather(*aws)
+    finally:
+        elapsed = time.monotonic() - start
+        threshold = _slow_log.threshold
+        level = logging.INFO if threshold is not None and elapsed >= threshold else logging.DEBUG
+        if logging.getLogger().isEnabledFor(level):
+            logging.log(level, 'gathered %d queries in %.3fms: %s', len(aws), elapsed * 1000,
+                        ', '.join('%s=%.3fms' % (name, t * 1000) for name, t in group.timings[first:]))
+
+
 # 根据输入的参数生成占位符列表
 def create_args_string(num):
     L = []
@@ -128,6 +1148,285 @@ def create_args_string(num):
     return ','.join(L)
 
 
+def encode_cursor(values):
+    """ 将分页位置(排序列的值, 主键)编码为不透明的续页令牌 """
+    data = json.dumps(list(values), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """ 解码续页令牌，令牌无效时抛出ValueError """
+    try:
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(data.decode('utf-8'))
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid page cursor: %s' % token)
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError('Invalid page cursor: %s' % token)
+    return values
+
+
+class RowCache(object):
+    """
+    按主键缓存行数据的有界LRU缓存，每个条目在ttl秒后过期
+    缓存中保存的是行数据的副本，每次命中都返回新的dict，调用者修改对象不会污染缓存
+    主键失效后的holdoff秒内不缓存该主键：这段时间内的读可能来自还没有复制到新数据的只读副本，
+    或者是在写入之前开始的查询，缓存它们会让旧数据保留整个ttl
+    """
+
+    def __init__(self, size=10000, ttl=60, holdoff=1.0):
+        self.size = size
+        self.ttl = ttl
+        self.holdoff = holdoff
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._rows = collections.OrderedDict()
+        # 主键 -> 可以重新缓存的时间，按失效的先后排列
+        self._invalidated = collections.OrderedDict()
+
+    def get(self, pk):
+        entry = self._rows.get(pk)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, row = entry
+        if expires < time.monotonic():
+            del self._rows[pk]
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._rows.move_to_end(pk)
+        return dict(row)
+
+    def set(self, pk, row):
+        now = time.monotonic()
+        until = self._invalidated.get(pk)
+        if until is not None:
+            if now < until:
+                return
+            del self._invalidated[pk]
+        self._rows[pk] = (now + self.ttl, dict(row))
+        self._rows.move_to_end(pk)
+        if len(self._rows) > self.size:
+            self._rows.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, pk):
+        self._rows.pop(pk, None)
+        if self.holdoff:
+            now = time.monotonic()
+            # 清理已经过了holdoff的记录，最早失效的在最前面
+            while self._invalidated:
+                key, until = next(iter(self._invalidated.items()))
+                if until > now:
+                    break
+                del self._invalidated[key]
+            self._invalidated[pk] = now + self.holdoff
+            self._invalidated.move_to_end(pk)
+
+    def clear(self):
+        self._rows.clear()
+        self._invalidated.clear()
+
+    def info(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    size=len(self._rows), maxsize=self.size, ttl=self.ttl)
+
+
+class CountCache(object):
+    """
+    findNumber聚合结果的缓存，以(表名, selectField, where, args)为键
+    每次写入表时递增写版本号(bump)，版本号不一致的条目即失效；
+    ttl限制其他进程写入数据库时结果过期的最长时间；
+    与RowCache一样，写入之后的holdoff秒内不缓存结果，避免缓存只读副本上的旧结果
+    """
+
+    def __init__(self, size=1000, ttl=60, holdoff=1.0):
+        self.size = size
+        self.ttl = ttl
+        self.holdoff = holdoff
+        self._holdoff_until = 0.0
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._counts = collections.OrderedDict()
+
+    def get(self, key):
+        entry = self._counts.get(key)
+        if entry is None or entry[0] != self.version or entry[1] < time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._counts.move_to_end(key)
+        return entry
+
+    def set(self, key, value):
+        now = time.monotonic()
+        if now < self._holdoff_until:
+            return
+        self._counts[key] = (self.version, now + self.ttl, value)
+        self._counts.move_to_end(key)
+        if len(self._counts) > self.size:
+            self._counts.popitem(last=False)
+
+    def bump(self):
+        self.version += 1
+        self._holdoff_until = time.monotonic() + self.holdoff
+
+    def info(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self._counts), maxsize=self.size,
+                    ttl=self.ttl, version=self.version)
+
+
+class FindLoader(object):
+    """
+    合并并发的Model.find调用
+    同一个时间窗口内（window为0时即事件循环的下一轮）到达的主键查询被收集起来，
+    通过一次findMany(WHERE pk IN (...))完成，再把结果分发给各自的调用者
+    """
+
+    def __init__(self, model, window=0, size=100):
+        self.model = model
+        self.window = window
+        self.size = size
+        self._pending = collections.OrderedDict()
+        self._handle = None
+
+    def load(self, pk):
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        self._pending.setdefault(pk, []).append(fut)
+        if len(self._pending) >= self.size:
+            self._dispatch()
+        elif self._handle is None:
+            # 批量查询在空的上下文中执行，不继承某一个调用者的事务或primary()设置
+            if self.window:
+                self._handle = loop.call_later(self.window, self._dispatch, context=contextvars.Context())
+            else:
+                self._handle = loop.call_soon(self._dispatch, context=contextvars.Context())
+        return fut
+
+    def _dispatch(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        pending, self._pending = self._pending, collections.OrderedDict()
+        if pending:
+            # 批次满时_dispatch在最后一个调用者的上下文中被调用，查询同样在空的上下文中执行
+            contextvars.Context().run(asyncio.ensure_future, self._fetch(pending))
+
+    async def _fetch(self, pending):
+        try:
+            rs = await self.model.findMany(list(pending.keys()))
+        except BaseException as e:
+            for futs in pending.values():
+                for fut in futs:
+                    if not fut.done():
+                        fut.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        for obj, futs in zip(rs, pending.values()):
+            for i, fut in enumerate(futs):
+                if fut.done():
+                    continue
+                # 同一主键的多个调用者各自得到独立的对象
+                if obj is not None and i > 0:
+                    fut.set_result(self.model._load(obj))
+                else:
+                    fut.set_result(obj)
+
+
+class SaveCoalescer(object):
+    """
+    合并并发的Model.save调用
+    同一个时间窗口内到达的（最多size个）INSERT合并为一条多行INSERT，一次往返、一次提交；
+    多行INSERT失败时（例如其中一行主键冲突，整条语句都不会生效）逐行重试，
+    每个调用者得到自己那一行的结果或异常。调用者被取消时它的行仍可能被插入
+    """
+
+    def __init__(self, model, window=0.002, size=100):
+        if size < 1:
+            raise ValueError('Invalid coalesce size: %s' % size)
+        self.model = model
+        self.window = window
+        self.size = size
+        self.batches = 0
+        self.fallbacks = 0
+        self._pending = []
+        self._handle = None
+
+    def save(self, args):
+        """ args为一行INSERT的参数，返回该行影响的行数的future """
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        self._pending.append((args, fut))
+        if len(self._pending) >= self.size:
+            self._dispatch()
+        elif self._handle is None:
+            # 合并的INSERT在空的上下文中执行，不继承某一个调用者的截止时间或连接预算
+            if self.window:
+                self._handle = loop.call_later(self.window, self._dispatch, context=contextvars.Context())
+            else:
+                self._handle = loop.call_soon(self._dispatch, context=contextvars.Context())
+        return fut
+
+    def _dispatch(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        pending, self._pending = self._pending, []
+        if pending:
+            # 批次满时_dispatch在最后一个调用者的上下文中被调用，INSERT同样在空的上下文中执行
+            contextvars.Context().run(asyncio.ensure_future, self._insert(pending))
+
+    async def _insert(self, pending):
+        model = self.model
+        # 调用者已经超过截止时间或被取消的行不再插入
+        pending = [(row, fut) for row, fut in pending if not fut.cancelled()]
+        if not pending:
+            return
+        if len(pending) > 1:
+            args = []
+            for row, _ in pending:
+                args.extend(row)
+            try:
+                await model._insert_rows(len(pending), args)
+            except Exception as e:
+                self.fallbacks += 1
+                logging.info('coalesced insert of %s %s rows failed, retry row by row: %s'
+                             % (len(pending), model.__name__, e))
+            except BaseException as e:
+                for _, fut in pending:
+                    if not fut.done():
+                        fut.set_exception(e)
+                raise
+            else:
+                self.batches += 1
+                for _, fut in pending:
+                    if not fut.done():
+                        fut.set_result(1)
+                return
+        for i, (row, fut) in enumerate(pending):
+            try:
+                rows = await execute(model.__insert__, row)
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+                continue
+            except BaseException as e:
+                for _, f in pending[i:]:
+                    if not f.done():
+                        f.set_exception(e)
+                raise
+            if not fut.done():
+                fut.set_result(rows)
+
+    def info(self):
+        return dict(batches=self.batches, fallbacks=self.fallbacks, pending=len(self._pending))
+
+
 # 定义Field类，负责保存（数据库）表的字段名和字段类型
 class Field(object):
     # 表的字段包含名字、类型、是否为表的主键和默认值
@@ -145,7 +1444,7 @@ class Field(object):
 # 定义不同类型的衍生Field
 # 表的不同列的字段的类型不同
 class StringField(Field):
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100'):
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
         super().__init__(name, ddl, primary_key, default)
 
 
@@ -165,8 +1464,379 @@ class FloatField(Field):
 
 
 class TextField(Field):
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
+    def __init__(self, name=None, default=None, ddl='text'):
+        super().__init__(name, ddl, False, default)
+
+
+# 二级索引的定义：索引名、属性名列表、是否唯一
+Index = collections.namedtuple('Index', ['name', 'fields', 'unique'])
+
+
+def _parse_indexes(tableName, mappings, indexes):
+    """
+    解析Model的__indexes__声明，每一项可以是：
+    - 属性名：'blog_id'
+    - 多个属性名组成的联合索引：('blog_id', 'created_at')
+    - dict(name='idx_email', fields=['email'], unique=True)
+    未指定索引名时为'idx_' + 各属性名
+    """
+    L = []
+    for index in indexes:
+        if isinstance(index, str):
+            index = dict(fields=[index])
+        elif isinstance(index, (tuple, list)):
+            index = dict(fields=list(index))
+        fields = list(index['fields'])
+        for f in fields:
+            if f not in mappings:
+                raise ValueError('Invalid index field for table %s: %s' % (tableName, f))
+        name = index.get('name', None) or 'idx_%s' % '_'.join(fields)
+        L.append(Index(name, tuple(fields), index.get('unique', False)))
+    return L
+
+
+# 只查询部分列的投影：SELECT语句头部、加载的属性名集合、对应的紧凑行对象类
+Projection = collections.namedtuple('Projection', ['sql', 'fields', 'row'])
+
+
+class CompactRow(object):
+    """
+    紧凑的只读行对象的基类，由ModelMetaclass为每个Model生成子类(Model.__row__)
+
+    每行只是一个__slots__对象，列名保存在类上由所有行共享，
+    不像Model那样每行都有DictCursor返回的dict和cls(**r)复制出的dict两张哈希表。
+    支持属性访问、row['key']、dict(row)和JSON序列化(row._asdict())
+    """
+
+    __slots__ = ()
+    __model__ = None
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._values() == other._values()
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join('%s=%r' % (k, v) for k, v in zip(self.__slots__, self._values())))
+
+    def _values(self):
+        return tuple(getattr(self, name, None) for name in self.__slots__)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self.__slots__
+
+    def _asdict(self):
+        return dict(zip(self.__slots__, self._values()))
+
+    def toModel(self):
+        """ 转换为Model对象，用于需要修改并保存的场景；投影的行转换为只加载了部分列的对象 """
+        model = self.__model__
+        fields = None if len(self.__slots__) == len(model.__fields__) + 1 else frozenset(self.__slots__)
+        return model._load(self._asdict(), fields)
+
+
+# Query.where支持的比较运算：where(created_at__gt=t)
+_OPERATORS = dict(eq='=', ne='<>', gt='>', gte='>=', lt='<', lte='<=', like=' like ', **{'in': ' in '})
+
+
+class Query(object):
+    """
+    不可变的查询对象，通过Model.query()创建，每个方法都返回一个新的Query：
+
+    blogs = await Blog.query().where(user_id=uid).order_by('-created_at').limit(20).all()
+
+    SQL只由查询的形状（条件的列和运算、排序、投影、是否有limit/offset、IN列表的长度）决定，
+    参数值不影响SQL，同一形状的查询只拼接一次SQL，之后直接复用缓存的语句
+    """
+
+    def __init__(self, model, filters=(), order=(), fields=None, limit=None, offset=None, compact=False,
+                 prefetch=()):
+        self._model = model
+        self._filters = filters
+        self._order = order
+        self._fields = fields
+        self._limit = limit
+        self._offset = offset
+        self._compact = compact
+        self._prefetch = prefetch
+
+    def _copy(self, **kw):
+        state = dict(filters=self._filters, order=self._order, fields=self._fields, limit=self._limit,
+                     offset=self._offset, compact=self._compact, prefetch=self._prefetch)
+        state.update(kw)
+        return Query(self._model, **state)
+
+    def _field(self, name):
+        if name not in self._model.__mappings__:
+            raise ValueError('Invalid field for %s: %s' % (self._model.__name__, name))
+        return name
+
+    def where(self, **kw):
+        """ 增加AND条件，列名后可以加__ne、__gt、__gte、__lt、__lte、__in、__like指定运算 """
+        filters = list(self._filters)
+        for key in sorted(kw):
+            name, _, op = key.partition('__')
+            op = op or 'eq'
+            if op not in _OPERATORS:
+                raise ValueError('Invalid operator: %s' % key)
+            value = kw[key]
+            if op == 'in':
+                value = tuple(value)
+            filters.append((self._field(name), op, value))
+        return self._copy(filters=tuple(filters))
+
+    def order_by(self, *fields):
+        """ 排序列，'-created_at'表示降序 """
+        order = tuple((self._field(f.lstrip('-')), f.startswith('-')) for f in fields)
+        return self._copy(order=order)
+
+    def limit(self, limit):
+        if limit < 0:
+            raise ValueError('Invalid limit value: %s' % limit)
+        return self._copy(limit=limit)
+
+    def offset(self, offset):
+        if offset < 0:
+            raise ValueError('Invalid offset value: %s' % offset)
+        return self._copy(offset=offset)
+
+    def only(self, *fields):
+        """ 只查询fields（以及主键），返回只加载了部分列的对象 """
+        for f in fields:
+            self._field(f)
+        return self._copy(fields=tuple(fields) or None)
+
+    def compact(self):
+        """ 返回只读的紧凑行对象而不是Model """
+        return self._copy(compact=True)
+
+    def prefetch(self, *names):
+        """ all()/first()返回之前批量加载names指定的关系，参见prefetch_related """
+        return self._copy(prefetch=self._prefetch + names)
+
+    def _compile(self, kind):
+        """ 返回(sql, args)，kind为'select'、'count'或'exists' """
+        model = self._model
+        filters = tuple((name, op, len(value) if op == 'in' else None) for name, op, value in self._filters)
+        if kind == 'select':
+            shape = (kind, filters, self._fields, self._order, self._limit is not None, self._offset is not None)
+        else:
+            shape = (kind, filters)
+        cache = model.__queries__
+        sql = cache.get(shape)
+        if sql is None:
+            if kind == 'select':
+                sql = [model._projection(self._fields).sql if self._fields else model.__select__]
+            elif kind == 'count':
+                sql = ['select count(*) _num_ from `%s`' % model.__table__]
+            else:
+                sql = ['select 1 _num_ from `%s`' % model.__table__]
+            conditions = []
+            for name, op, n in filters:
+                if op == 'in':
+                    # 空的IN列表不匹配任何行
+                    conditions.append('`%s` in (%s)' % (_column(model, name), create_args_string(n)) if n else '1=0')
+                else:
+                    conditions.append('`%s`%s?' % (_column(model, name), _OPERATORS[op]))
+            if conditions:
+                sql.append('where ' + ' and '.join(conditions))
+            if kind == 'select':
+                if self._order:
+                    sql.append('order by ' + ', '.join('`%s` %s' % (_column(model, name), 'desc' if desc else 'asc')
+                                                       for name, desc in self._order))
+                if self._limit is not None:
+                    sql.append('limit ?')
+                if self._offset is not None:
+                    # MySQL和SQLite都不支持只有OFFSET没有LIMIT
+                    sql.append('offset ?' if self._limit is not None else 'limit 9223372036854775807 offset ?')
+            elif kind == 'exists':
+                sql.append('limit 1')
+            sql = ' '.join(sql)
+            if len(cache) >= 1024:
+                cache.clear()
+            cache[shape] = sql
+        args = []
+        for name, op, value in self._filters:
+            if op == 'in':
+                args.extend(value)
+            else:
+                args.append(value)
+        if kind == 'select':
+            if self._limit is not None:
+                args.append(self._limit)
+            if self._offset is not None:
+                args.append(self._offset)
+        return sql, args
+
+    def _rows(self, rs):
+        model = self._model
+        if self._compact:
+            row = model._projection(self._fields).row if self._fields else model.__row__
+            return [row(*r) for r in rs]
+        loaded = model._projection(self._fields).fields if self._fields else None
+        return [model._load(r, loaded) for r in rs]
+
+    async def all(self):
+        if self._prefetch and self._compact:
+            raise ValueError('Cannot prefetch relations of compact rows.')
+        sql, args = self._compile('select')
+        rs = self._rows(await select(sql, args, as_dict=not self._compact))
+        return await prefetch_related(rs, *self._prefetch)
+
+    async def first(self):
+        rs = await self.limit(1).all()
+        return rs[0] if rs else None
+
+    async def count(self):
+        """ COUNT(*)，开启了__count_cache__的模型在事务之外使用缓存 """
+        sql, args = self._compile('count')
+        model = self._model
+        cache = model.__countcache__ if _current_tx.get() is None else None
+        if cache is not None:
+            key = (model.__table__, sql, tuple(args))
+            entry = cache.get(key)
+            if entry is not None:
+                return entry[2]
+        rs = await select(sql, args, 1)
+        num = rs[0]['_num_'] if rs else 0
+        if cache is not None:
+            cache.set(key, num)
+        return num
+
+    async def exists(self):
+        sql, args = self._compile('exists')
+        return len(await select(sql, args, 1)) > 0
+
+    async def iter(self, chunk=500):
+        """ 使用服务器端游标逐个返回结果，参见Model.iterAll """
+        sql, args = self._compile('select')
+        async for rs in iterate(sql, args, chunk, as_dict=not self._compact):
+            for r in self._rows(rs):
+                yield r
+
+    def __aiter__(self):
+        return self.iter()
+
+    def __repr__(self):
+        sql, args = self._compile('select')
+        return '<Query %s %r>' % (sql, args)
+
+
+# 所有Model子类，按类名注册，关系通过类名引用目标Model
+_models = dict()
+
+
+class Relation(object):
+    """
+    Model之间的关系，声明为Model的类属性，目标Model用类名引用，可以在目标Model定义之前声明：
+
+    class Blog(Model):
+        comments = HasMany('Comment', 'blog_id', order_by='created_at')
+
+    关系不会自动查询，通过findAll(..., prefetch=['comments'])、Query.prefetch('comments')
+    或orm.prefetch_related(objs, 'comments')批量加载之后，用blog.comments访问
+    """
+
+    def __init__(self, model, foreign_key):
+        self.model_name = model
+        self.foreign_key = foreign_key
+        # 关系的属性名，由ModelMetaclass设置
+        self.name = None
+
+    @property
+    def target(self):
+        try:
+            return _models[self.model_name]
+        except KeyError:
+            raise ValueError('Unknown model for relation %s: %s' % (self.name, self.model_name))
+
+    def __get__(self, obj, owner):
+        if obj is None:
+            return self
+        try:
+            return dict.__getitem__(obj, self.name)
+        except KeyError:
+            raise AttributeError('Relation %s.%s was not prefetched' % (owner.__name__, self.name))
+
+    async def load(self, objs):
+        """ 用一条（IN列表很长时分批的）查询加载objs的关系，返回加载的所有目标对象 """
+        raise NotImplementedError
+
+
+class BelongsTo(Relation):
+    """ 多对一：外键在当前Model上，例如Comment.user = BelongsTo('User', 'user_id') """
+
+    async def load(self, objs):
+        keys = list(dict.fromkeys(obj.get(self.foreign_key) for obj in objs if obj.get(self.foreign_key) is not None))
+        # 通过findMany加载，目标Model开启了行缓存时命中的行不需要查询
+        targets = dict()
+        for target in await self.target.findMany(keys):
+            if target is not None:
+                targets[target[target.__primary_key__]] = target
+        for obj in objs:
+            dict.__setitem__(obj, self.name, targets.get(obj.get(self.foreign_key)))
+        return list(targets.values())
+
+
+class HasMany(Relation):
+    """ 一对多：外键在目标Model上，例如Blog.comments = HasMany('Comment', 'blog_id', order_by='created_at') """
+
+    def __init__(self, model, foreign_key, order_by=None, chunk=1000):
+        super(HasMany, self).__init__(model, foreign_key)
+        self.order_by = order_by
+        self.chunk = chunk
+
+    async def load(self, objs):
+        keys = list(dict.fromkeys(obj[obj.__primary_key__] for obj in objs))
+        query = self.target.query()
+        if self.order_by:
+            query = query.order_by(self.order_by)
+        groups = dict((key, []) for key in keys)
+        loaded = []
+        for i in range(0, len(keys), self.chunk):
+            for r in await query.where(**{'%s__in' % self.foreign_key: keys[i:i + self.chunk]}).all():
+                groups[r[self.foreign_key]].append(r)
+                loaded.append(r)
+        for obj in objs:
+            dict.__setitem__(obj, self.name, groups[obj[obj.__primary_key__]])
+        return loaded
+
+
+async def prefetch_related(objs, *names):
+    """
+    批量加载objs（同一个Model的对象列表）的关系，每个关系一条查询，不会产生N+1查询
+    嵌套的关系用'.'分隔，例如prefetch_related(blogs, 'comments.user')先加载所有博客的评论，再加载这些评论的作者
+    :return: objs
+    """
+    if not objs or not names:
+        return objs
+    model = type(objs[0])
+    nested = collections.OrderedDict()
+    for name in names:
+        head, _, rest = name.partition('.')
+        nested.setdefault(head, [])
+        if rest:
+            nested[head].append(rest)
+    for name, rest in nested.items():
+        relation = model.__relations__.get(name)
+        if relation is None:
+            raise ValueError('Invalid relation for %s: %s' % (model.__name__, name))
+        loaded = await relation.load(objs)
+        if rest:
+            await prefetch_related(loaded, *rest)
+    return objs
 
 
 class ModelMetaclass(type):
@@ -201,9 +1871,14 @@ class ModelMetaclass(type):
 
         # 获取Field和主键名
         mappings = dict()
+        relations = dict()
         fields = []
         primaryKey = None
         for k, v in attrs.items():
+            # 关系属性保留在类上，用于访问预加载的结果
+            if isinstance(v, Relation):
+                v.name = k
+                relations[k] = v
             # Field属性
             if isinstance(v, Field):
                 # k是类的一个属性，v是这个属性在数据库中对应的Field列表属性
@@ -234,6 +1909,7 @@ class ModelMetaclass(type):
         attrs['__table__'] = tableName  # 保存表名
         attrs['__primary_key__'] = primaryKey  # 主键属性名
         attrs['__fields__'] = fields  # 除主键外的属性名
+        attrs['__indexes__'] = _parse_indexes(tableName, mappings, attrs.get('__indexes__', ()))  # 二级索引
 
         # 构造默认的SELECT、INSERT、UPDATE、DELETE语句
         # ``反引号功能同repr()
@@ -243,7 +1919,42 @@ class ModelMetaclass(type):
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (
             tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        # 多行INSERT：语句头部和每一行的占位符，由save_many按批次拼接
+        attrs['__insert_many__'] = 'insert into `%s` (%s, `%s`) values ' % (
+            tableName, ', '.join(escaped_fields), primaryKey)
+        attrs['__insert_row__'] = '(%s)' % create_args_string(len(escaped_fields) + 1)
+        # 按主键的行缓存，子类通过__cache__ = dict(size=..., ttl=...)开启
+        cache = attrs.get('__cache__', None)
+        attrs['__rowcache__'] = RowCache(**cache) if cache else None
+        # findNumber的结果缓存，子类通过__count_cache__ = dict(size=..., ttl=...)开启
+        counts = attrs.get('__count_cache__', None)
+        attrs['__countcache__'] = CountCache(**counts) if counts else None
+        # 按投影缓存的SELECT语句和UPDATE语句
+        attrs['__projections__'] = dict()
+        attrs['__updates__'] = dict()
+        # Query按形状缓存的SQL
+        attrs['__queries__'] = dict()
+        attrs['__relations__'] = relations
+        model = type.__new__(cls, name, bases, attrs)
+        # 合并并发find调用的批量加载器，子类通过__batch_find__ = dict(window=..., size=...)开启
+        batch = attrs.get('__batch_find__', None)
+        model.__findloader__ = FindLoader(model, **batch) if batch else None
+        # 合并并发save调用的写入合并器，子类通过__coalesce__ = dict(window=..., size=...)开启
+        coalesce = attrs.get('__coalesce__', None)
+        model.__coalescer__ = SaveCoalescer(model, **coalesce) if coalesce else None
+        # 紧凑行对象的类，槽的顺序与__select__中列的顺序一致，可以直接由tuple构造
+        model.__row__ = type('%sRow' % name, (CompactRow,), dict(__slots__=tuple([primaryKey] + fields), __model__=model))
+        _models[name] = model
+        return model
+
+
+def _packet_size(value):
+    '''
+    估算参数在数据包中占用的字节数，按UTF-8编码计算而不是字符数
+    '''
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    return len(str(value).encode('utf-8'))
 
 
 class Model(dict, metaclass=ModelMetaclass):
@@ -257,6 +1968,15 @@ class Model(dict, metaclass=ModelMetaclass):
     实现数据库操作的所有方法，定义为class方法，所有继承自Model都具有数据库操作方法
     """
 
+    __rowcache__ = None
+    __countcache__ = None
+    __findloader__ = None
+    __coalescer__ = None
+    # 只加载了部分列的对象记录加载的属性名集合，完整加载的对象为None
+    _loaded = None
+    # 从数据库读出（或已保存）的对象记录之后被修改过的属性名集合，新构造的对象为None（不跟踪）
+    _dirty = None
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
 
@@ -269,6 +1989,12 @@ class Model(dict, metaclass=ModelMetaclass):
     def __setattr__(self, key, value):
         self[key] = value
 
+    def __setitem__(self, key, value):
+        dirty = self._dirty
+        if dirty is not None and (key not in self or dict.__getitem__(self, key) != value):
+            dirty.add(key)
+        super(Model, self).__setitem__(key, value)
+
     def getValue(self, key):
         return getattr(self, key, None)
 
@@ -285,14 +2011,50 @@ class Model(dict, metaclass=ModelMetaclass):
     # 类方法有类变量cls传入，从而可以用cls做一些相关的处理。
     # 并且有子类继承时，调用该类方法时，传入的类变量cls是子类，而非父类。
     @classmethod
-    async def findAll(cls, where=None, args=None, **kw):
-        ' find objects by where clause. '
-        sql = [cls.__select__]
+    def _projection(cls, fields):
+        """ 返回只查询fields（以及主键）的投影，每种投影的SQL只生成一次 """
+        key = tuple(fields)
+        projection = cls.__projections__.get(key)
+        if projection is None:
+            for f in fields:
+                if f not in cls.__mappings__:
+                    raise ValueError('Invalid field for %s: %s' % (cls.__name__, f))
+            # 保持与__select__相同的列顺序，主键总是被加载
+            names = [cls.__primary_key__] + [f for f in cls.__fields__ if f in fields]
+            sql = 'select %s from `%s`' % (', '.join(map(lambda f: '`%s`' % f, names)), cls.__table__)
+            row = type('%sRow' % cls.__name__, (CompactRow,), dict(__slots__=tuple(names), __model__=cls))
+            projection = Projection(sql, frozenset(names), row)
+            cls.__projections__[key] = projection
+        return projection
+
+    @classmethod
+    def _load(cls, r, fields=None):
+        """
+        由数据库中读出的行构造对象，所有查询都通过这里构造对象
+        对象开始跟踪被修改的属性，update()只写入修改过的列
+        :param fields: 只加载了部分列时为加载的列名集合
+        """
+        obj = cls(**r)
+        d = obj.__dict__
+        d['_dirty'] = set()
+        if fields is not None:
+            d['_loaded'] = fields
+        return obj
+
+    @classmethod
+    def query(cls):
+        """ 返回查询整个表的Query，参见Query """
+        return Query(cls)
+
+    @classmethod
+    def _select_sql(cls, where=None, args=None, fields=None, **kw):
+        """ 根据fields、where、orderBy、limit拼接SELECT语句，返回(sql, args) """
+        sql = [cls._projection(fields).sql if fields else cls.__select__]
         if where:
             sql.append('where')
             sql.append(where)
-        if args is None:
-            args = []
+        # 复制一份参数，避免修改调用者传入的列表
+        args = list(args) if args else []
         orderBy = kw.get('orderBy', None)
         if orderBy:
             sql.append('order by')
@@ -308,12 +2070,114 @@ class Model(dict, metaclass=ModelMetaclass):
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        return ' '.join(sql), args
+
+    @classmethod
+    async def findAll(cls, where=None, args=None, compact=False, fields=None, prefetch=None, **kw):
+        """
+        find objects by where clause.
+        compact为True时返回只读的紧凑行对象(cls.__row__)，适合大量只读数据
+        fields指定只查询的列（主键总是被查询），例如列表页不需要加载content
+        prefetch指定批量加载的关系，例如Blog.findAll(prefetch=['comments'])，每个关系一条查询
+        """
+        sql, args = cls._select_sql(where, args, fields, **kw)
+        if compact:
+            if prefetch:
+                raise ValueError('Cannot prefetch relations of compact rows.')
+            row = cls._projection(fields).row if fields else cls.__row__
+            rs = await select(sql, args, as_dict=False)
+            return [row(*r) for r in rs]
+        rs = await select(sql, args)
+        loaded = cls._projection(fields).fields if fields else None
+        objs = [cls._load(r, loaded) for r in rs]
+        if prefetch:
+            await prefetch_related(objs, *prefetch)
+        return objs
+
+    @classmethod
+    async def iterAll(cls, where=None, args=None, chunk=500, compact=False, fields=None, **kw):
+        """
+        以异步迭代器的形式逐个返回查询结果：async for blog in Blog.iterAll(...)
+        使用服务器端游标按chunk分批读取，内存占用与结果集大小无关，适合导出、重建索引等全表扫描
+        迭代期间一直占用一个连接，提前退出循环时应关闭迭代器以尽快归还连接
+        """
+        sql, args = cls._select_sql(where, args, fields, **kw)
+        if compact:
+            row = cls._projection(fields).row if fields else cls.__row__
+            async for rs in iterate(sql, args, chunk, as_dict=False):
+                for r in rs:
+                    yield row(*r)
+            return
+        loaded = cls._projection(fields).fields if fields else None
+        async for rs in iterate(sql, args, chunk):
+            for r in rs:
+                yield cls._load(r, loaded)
 
     @classmethod
-    async def findNumber(cls, selectField, where=None, args=None):
-        'find number by select and where'
+    async def findPage(cls, where=None, args=None, after=None, size=10, order='created_at desc', fields=None,
+                       prefetch=None):
+        """
+        基于键集(seek)的分页查询，代替findAll(limit=(offset, n))
+        按(排序列, 主键)定位上一页的最后一行，WHERE条件直接命中索引，任意深度的分页开销都和第一页相同
+        :param where: 额外的过滤条件
+        :param args:
+        :param after: 上一页返回的续页令牌，None表示第一页
+        :param size: 每页的行数
+        :param order: 排序列和方向，例如'created_at desc'
+        :param fields: 只查询的列，排序列总是被查询
+        :param prefetch: 批量加载的关系，只加载本页的对象的关系
+        :return: (本页对象列表, 下一页的续页令牌)，没有下一页时令牌为None
+        """
+        column, _, direction = order.strip().partition(' ')
+        direction = direction.strip().lower() or 'asc'
+        if column not in cls.__mappings__ or direction not in ('asc', 'desc'):
+            raise ValueError('Invalid order value: %s' % order)
+        if size < 1:
+            raise ValueError('Invalid size value: %s' % size)
+        pk = cls.__primary_key__
+        conditions = []
+        args = list(args) if args else []
+        if where:
+            conditions.append('(%s)' % where)
+        if after is not None:
+            value, key = decode_cursor(after)
+            op = '<' if direction == 'desc' else '>'
+            conditions.append('(`%s`%s? or (`%s`=? and `%s`%s?))' % (column, op, column, pk, op))
+            args.extend([value, value, key])
+        if fields and column not in fields:
+            fields = list(fields) + [column]
+        # 多取一行，用来判断是否还有下一页
+        items = await cls.findAll(' and '.join(conditions) or None, args, fields=fields,
+                                  orderBy='`%s` %s, `%s` %s' % (column, direction, pk, direction), limit=size + 1)
+        token = None
+        if len(items) > size:
+            items = items[:size]
+            last = items[-1]
+            token = encode_cursor((last[column], last[pk]))
+        if prefetch:
+            await prefetch_related(items, *prefetch)
+        return items, token
+
+    @classmethod
+    async def findNumber(cls, selectField, where=None, args=None, approximate=False):
+        """
+        find number by select and where
+        开启了__count_cache__的模型在表没有写入时直接返回缓存的结果，事务中不使用缓存。
+        approximate为True时读取表行数的统计值（MySQL的information_schema），不执行COUNT，
+        只能用于没有where条件的情况，适合非常大的表；后端没有统计值时（SQLite）执行COUNT
+        """
+        if approximate:
+            if where:
+                raise ValueError('Approximate count does not support where clause.')
+            sql, args = _backend.approximate_count_sql(cls.__table__)
+            rs = await select(sql, args, 1)
+            return rs[0]['_num_'] if rs else None
+        cache = cls.__countcache__ if _current_tx.get() is None else None
+        if cache is not None:
+            key = (cls.__table__, selectField, where, tuple(args) if args else ())
+            entry = cache.get(key)
+            if entry is not None:
+                return entry[2]
         sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
         if where:
             sql.append('where')
@@ -321,32 +2185,345 @@ class Model(dict, metaclass=ModelMetaclass):
         rs = await select(' '.join(sql), args, 1)
         if len(rs) == 0:
             return None
+        if cache is not None:
+            cache.set(key, rs[0]['_num_'])
         return rs[0]['_num_']
 
     @classmethod
-    async def find(cls, pk):
-        ' find object by primary key. '
+    async def find(cls, pk, fields=None):
+        """
+        find object by primary key.
+        fields指定只查询的列；行缓存命中时直接返回完整的对象
+        """
+        # 事务中的查询必须使用事务的连接，不经过行缓存和批量加载器
+        intx = _current_tx.get() is not None
+        cache = cls.__rowcache__ if not intx else None
+        if cache is not None:
+            r = cache.get(pk)
+            if r is not None:
+                return cls._load(r)
+        if fields:
+            projection = cls._projection(fields)
+            rs = await select('%s where `%s`=?' % (projection.sql, cls.__primary_key__), [pk], 1)
+            return cls._load(rs[0], projection.fields) if rs else None
+        if cls.__findloader__ is not None and not intx and not _use_primary.get():
+            # 批量查询不受某一个调用者的截止时间限制，每个调用者各自等待到自己的截止时间
+            return await _bounded(cls.__findloader__.load(pk))
         rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        if cache is not None:
+            cache.set(pk, rs[0])
+        return cls._load(rs[0])
 
-    async def save(self):
+    @classmethod
+    async def findMany(cls, pks, chunk=1000):
+        """
+        按主键批量查找，使用WHERE pk IN (...)代替逐个的find
+        :param pks: 主键列表
+        :param chunk: 单条语句中IN列表的最大长度
+        :return: 与pks一一对应的对象列表，不存在的主键对应None
+        """
+        cache = cls.__rowcache__ if _current_tx.get() is None else None
+        rows = dict()
+        missing = []
+        seen = set()
+        for pk in pks:
+            if pk in seen:
+                continue
+            seen.add(pk)
+            r = cache.get(pk) if cache is not None else None
+            if r is not None:
+                rows[pk] = r
+            else:
+                missing.append(pk)
+        pkName = cls.__primary_key__
+        for i in range(0, len(missing), chunk):
+            part = missing[i:i + chunk]
+            rs = await select('%s where `%s` in (%s)' % (cls.__select__, pkName, create_args_string(len(part))), part)
+            for r in rs:
+                rows[r[pkName]] = r
+                if cache is not None:
+                    cache.set(r[pkName], r)
+        return [cls._load(rows[pk]) if pk in rows else None for pk in pks]
+
+    @classmethod
+    def cacheInfo(cls):
+        """ 返回行缓存的命中、未命中和淘汰统计，未开启缓存时返回None """
+        cache = cls.__rowcache__
+        return cache.info() if cache is not None else None
+
+    @classmethod
+    def countCacheInfo(cls):
+        """ 返回findNumber缓存的命中、未命中统计和当前写版本号，未开启缓存时返回None """
+        cache = cls.__countcache__
+        return cache.info() if cache is not None else None
+
+    @classmethod
+    def coalesceInfo(cls):
+        """ 返回写入合并的批次数、退回逐行插入的次数和等待中的行数，未开启时返回None """
+        coalescer = cls.__coalescer__
+        return coalescer.info() if coalescer is not None else None
+
+    @classmethod
+    def _written(cls):
+        """ 表被写入之后递增计数缓存的写版本号 """
+        cache = cls.__countcache__
+        if cache is not None:
+            cache.bump()
+            tx = _current_tx.get()
+            if tx is not None:
+                tx.after_commit(cache.bump)
+
+    def _invalidate(self):
+        self._written()
+        cache = self.__rowcache__
+        if cache is not None:
+            pk = self.getValue(self.__primary_key__)
+            cache.invalidate(pk)
+            # 事务提交之前其他请求仍可能把旧数据读入缓存，提交后再失效一次
+            tx = _current_tx.get()
+            if tx is not None:
+                tx.after_commit(lambda: cache.invalidate(pk))
+
+    def _insert_args(self):
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.append(self.getValueOrDefault(self.__primary_key__))
-        rows = await execute(self.__insert__, args)
+        return args
+
+    @classmethod
+    def _unique_keys(cls):
+        """ 插入时可能发生冲突的键：主键和各个唯一索引的列 """
+        return [(cls.__primary_key__,)] + [tuple(index.fields) for index in cls.__indexes__ if index.unique]
+
+    @classmethod
+    def isDuplicate(cls, exc, index=None):
+        """
+        save()抛出的异常exc是否为与已有行的主键或唯一索引冲突：
+        try:
+            await user.save()
+        except Exception as e:
+            if not User.isDuplicate(e, 'idx_email'):
+                raise
+        :param index: __indexes__中唯一索引的名称，默认匹配主键和任意唯一索引
+        """
+        if index is None:
+            return _backend.duplicate_key(exc, cls.__table__, None, None)
+        for i in cls.__indexes__:
+            if i.unique and i.name == index:
+                return _backend.duplicate_key(exc, cls.__table__, index, [_column(cls, f) for f in i.fields])
+        raise ValueError('Invalid unique index for %s: %s' % (cls.__name__, index))
+
+    async def save(self, ignore_duplicates=False):
+        """
+        插入对象
+        ignore_duplicates为True时，与已有行的主键或唯一索引冲突的对象被忽略而不是抛出异常（MySQL的INSERT IGNORE），
+        一条语句即可完成唯一性检查和插入
+        :return: 是否插入了新行
+        """
+        args = self._insert_args()
+        coalescer = self.__coalescer__
+        if ignore_duplicates:
+            rows = await execute(_backend.insert_ignore_sql(self.__insert__), args)
+            if rows == 0:
+                return False
+        elif coalescer is not None and _current_tx.get() is None:
+            # 事务中的插入必须使用事务的连接，不参与合并；合并后的INSERT在空的上下文中执行，在这里应用调用者的截止时间
+            rows = await _bounded(coalescer.save(args))
+        else:
+            rows = await execute(self.__insert__, args)
+        self._invalidate()
+        # 保存之后对象与数据库一致，开始跟踪修改
+        self.__dict__['_dirty'] = set()
         if rows != 1:
             logging.warn('failed to insert record: affected rows: %s' % rows)
+        return rows == 1
+
+    async def upsert(self, update_fields=None):
+        """
+        插入对象，与已有行的主键或唯一索引冲突时改为更新已有行的update_fields（默认为所有非主键列）
+        MySQL使用一条INSERT ... ON DUPLICATE KEY UPDATE；
+        SQLite在事务中先INSERT OR IGNORE，冲突时再按主键、各个唯一索引依次尝试更新
+        :return: True表示插入了新行，False表示更新了已有的行
+        """
+        fields = tuple(update_fields) if update_fields else tuple(self.__fields__)
+        for f in fields:
+            if f not in self.__fields__:
+                raise ValueError('Invalid field for %s: %s' % (self.__class__.__name__, f))
+        args = self._insert_args()
+        sql = _backend.upsert_sql(self.__insert__, [_column(self, f) for f in fields])
+        if sql is not None:
+            # MySQL的影响行数：1表示插入，2表示更新，0表示已有的行与新值相同
+            inserted = await execute(sql, args) == 1
+        else:
+            async with transaction():
+                inserted = await execute(_backend.insert_ignore_sql(self.__insert__), args) == 1
+                if not inserted:
+                    for keys in self._unique_keys():
+                        if await execute(self._update_sql(fields, keys), list(map(self.getValue, fields + keys))):
+                            break
+        self._invalidate()
+        if inserted:
+            self.__dict__['_dirty'] = set()
+            return True
+        # 更新的行的其他列和主键不一定与对象一致，停止跟踪修改
+        self.__dict__['_dirty'] = None
+        cache = self.__rowcache__
+        if cache is not None and len(self._unique_keys()) > 1:
+            # 冲突的可能是唯一索引，已有行的主键与对象的主键不同，查出来让它的缓存失效
+            conditions = []
+            keyArgs = []
+            for keys in self._unique_keys():
+                conditions.append('(%s)' % ' and '.join('`%s`=?' % _column(self, k) for k in keys))
+                keyArgs.extend(map(self.getValue, keys))
+            pk = self.__primary_key__
+            rs = await select('select `%s` from `%s` where %s' % (_column(self, pk), self.__table__,
+                                                                 ' or '.join(conditions)), keyArgs)
+            for r in rs:
+                cache.invalidate(r[_column(self, pk)])
+        return False
+
+    @classmethod
+    async def save_many(cls, objs, batch_size=500, max_packet=1024 * 1024):
+        """
+        批量保存对象，使用多行INSERT代替逐行的save()
+        每个批次最多batch_size行，同时按参数的估算大小切分，保证单条语句不超过服务器的max_allowed_packet
+        :param objs: 要保存的对象列表
+        :param batch_size: 每个批次的最大行数
+        :param max_packet: 单条语句的最大字节数（估算值）
+        :return: 每个批次影响的行数列表
+        """
+        if batch_size < 1:
+            raise ValueError('Invalid batch_size: %s' % batch_size)
+        keys = cls.__fields__ + [cls.__primary_key__]
+        base = len(cls.__insert_many__)
+        results = []
+        args = []
+        rows = 0
+        size = base
+        for obj in objs:
+            row = list(map(obj.getValueOrDefault, keys))
+            # 估算这一行在SQL文本中占用的字节数：值本身加上引号、逗号和转义的余量
+            row_size = len(cls.__insert_row__) + sum(_packet_size(v) + 4 for v in row)
+            if rows and (rows >= batch_size or size + row_size > max_packet):
+                results.append(await cls._insert_rows(rows, args))
+                args = []
+                rows = 0
+                size = base
+            args.extend(row)
+            rows += 1
+            size += row_size
+        if rows:
+            results.append(await cls._insert_rows(rows, args))
+        return results
+
+    @classmethod
+    async def _insert_rows(cls, rows, args):
+        sql = cls.__insert_many__ + ', '.join([cls.__insert_row__] * rows)
+        affected = await execute(sql, args)
+        cls._written()
+        if affected != rows:
+            logging.warning('failed to insert records: expected %s rows, affected rows: %s' % (rows, affected))
+        return affected
+
+    @classmethod
+    def _update_sql(cls, fields, keys=None):
+        """ 返回只更新fields、按keys（默认为主键）定位行的UPDATE语句，每种组合只生成一次 """
+        keys = keys or (cls.__primary_key__,)
+        sql = cls.__updates__.get((fields, keys))
+        if sql is None:
+            sql = 'update `%s` set %s where %s' % (
+                cls.__table__, ', '.join(map(lambda f: '`%s`=?' % _column(cls, f), fields)),
+                ' and '.join(map(lambda k: '`%s`=?' % _column(cls, k), keys)))
+            cls.__updates__[(fields, keys)] = sql
+        return sql
 
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
+        """
+        按主键更新对象
+        从数据库读出的对象只更新修改过的列，没有修改时不执行任何语句；
+        自行构造的对象不知道哪些列被修改过，更新所有（已加载的）列
+        """
+        loaded = self._loaded
+        if loaded is not None:
+            # 只加载了部分列的对象只能更新加载过的列，避免把没有加载的列覆盖为None
+            unloaded = [f for f in self.__fields__ if f not in loaded and f in self]
+            if unloaded:
+                raise ValueError('Cannot update fields that were not loaded: %s' % ', '.join(unloaded))
+        dirty = self._dirty
+        if dirty is not None:
+            fields = tuple(f for f in self.__fields__ if f in dirty)
+        elif loaded is not None:
+            fields = tuple(f for f in self.__fields__ if f in loaded)
+        else:
+            fields = self.__fields__
+        if not fields:
+            logging.debug('skip update of unchanged %s' % self.__class__.__name__)
+            return
+        sql = self.__update__ if len(fields) == len(self.__fields__) else self._update_sql(fields)
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        rows = await execute(sql, args)
+        self._invalidate()
+        self.__dict__['_dirty'] = set()
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: %s' % rows)
 
     async def remove(self):
         args = [self.getValue(self.__primary_key__)]
         rows = await execute(self.__delete__, args)
+        self._invalidate()
         if rows != 1:
             logging.warn('failed to remove by primary key: affected rows: %s' % rows)
+
+
+def _column(cls, key):
+    return cls.__mappings__[key].name or key
+
+
+def _index_columns(cls):
+    return [(index.name, [_column(cls, f) for f in index.fields], index.unique) for index in cls.__indexes__]
+
+
+def create_index_sql(cls):
+    """ 根据Model的__indexes__生成CREATE INDEX语句列表，用于给已有的表补充索引 """
+    return _current_backend().create_index_sql(cls.__table__, _index_columns(cls))
+
+
+def create_table_sql(cls):
+    """
+    根据Model的Field定义和__indexes__生成CREATE TABLE语句，MySQL的格式与schema.sql一致
+    SQLite不支持在建表语句中定义索引，需要再执行create_index_sql(cls)
+    """
+    columns = [(_column(cls, k), f.column_type) for k, f in cls.__mappings__.items()]
+    return _current_backend().create_table_sql(cls.__table__, columns, _column(cls, cls.__primary_key__),
+                                               _index_columns(cls))
+
+
+def _current_backend():
+    # 还没有创建连接池时按MySQL生成DDL
+    return _backend if _backend is not None else backends.MySQLBackend()
+
+
+async def index_report(min_rows=0):
+    """
+    对ORM执行过的每种SELECT/UPDATE/DELETE语句执行EXPLAIN（使用第一次执行时的参数），
+    找出全表扫描(type=ALL)、filesort和临时表
+    :param min_rows: 只报告预估扫描行数不少于min_rows的问题，忽略很小的表
+    :return: 问题列表，每项为dict(sql=, table=, type=, key=, rows=, problems=[...])
+    """
+    report = []
+    for sql, args in list(_issued.values()):
+        if not sql.lstrip().lower().startswith(('select', 'update', 'delete')):
+            continue
+        try:
+            plan = await select(_backend.explain_sql(sql), args)
+        except Exception as e:
+            logging.warning('failed to explain %s: %s' % (sql, e))
+            continue
+        for r in plan:
+            problems = _backend.plan_problems(r)
+            if problems and (r.get('rows') or 0) >= min_rows:
+                report.append(dict(sql=sql, table=r.get('table'), type=r.get('type'), key=r.get('key'),
+                                   rows=r.get('rows'), problems=problems))
+    return report
@@ -15,22 +15,123 @@ code is far away from bugs with the god animal protecting
 """
 
 import asyncio
+import os
+import sys
+import tempfile
 
-from www.models import User
+from www import orm
+from www.models import User, Blog, Comment
 from www.orm import create_pool, destroy_pool
 
 __author__ = 'fjzhang'
 
+
+async def conformance():
+    """
+    Model API一致性测试：在已经创建的连接池上重建表，并依次验证
+    save/find/findAll/findNumber/update/remove在当前后端上的行为
+    """
+    for model in (User, Blog, Comment):
+        await orm.execute('drop table if exists `%s`' % model.__table__, [])
+        await orm.execute(orm.create_table_sql(model), [])
+        for sql in orm.create_index_sql(model) if orm._backend.name == 'sqlite' else []:
+            await orm.execute(sql, [])
+
+    u = User(name='Test', email='test@example.com', passwd='1234567890', image='about:blank')
+    await u.save()
+    r = await User.find(u.id)
+    assert r is not None and r.email == 'test@example.com' and r.name == 'Test', r
+    assert await User.find('not-exist') is None
+
+    for i in range(5):
+        await Blog(user_id=u.id, user_name=u.name, user_image=u.image, name='Blog %s' % i,
+                   summary='summary', content='content %s' % i, created_at=1000.0 + i).save()
+    blogs = await Blog.findAll('user_id=?', [u.id], orderBy='created_at desc')
+    assert [b.name for b in blogs] == ['Blog %s' % i for i in range(4, -1, -1)], blogs
+    blogs = await Blog.findAll(orderBy='created_at', limit=(1, 2))
+    assert [b.name for b in blogs] == ['Blog 1', 'Blog 2'], blogs
+    assert await Blog.findNumber('count(id)') == 5
+    assert await Blog.findNumber('count(id)', 'created_at>?', [1002.0]) == 2
+
+    q = Blog.query().where(user_id=u.id)
+    blogs = await q.where(created_at__gte=1001.0).order_by('-created_at').limit(2).all()
+    assert [b.name for b in blogs] == ['Blog 4', 'Blog 3'], blogs
+    assert await q.count() == 5 and await q.where(name__in=['Blog 0', 'Blog 9']).count() == 1
+    assert await q.where(name='Blog 9').exists() is False
+    assert (await q.only('name').order_by('created_at').offset(4).first()).name == 'Blog 4'
+    assert [b.name async for b in q.compact().where(name__in=[]).iter()] == []
+
+    blogs = await Blog.findAll(orderBy='created_at', limit=(1, 2))
+    b = blogs[0]
+    b.summary = 'changed'
+    await b.update()
+    assert (await Blog.findAll('id=?', [b.id]))[0].summary == 'changed'
+    await b.remove()
+    assert await Blog.findAll('id=?', [b.id]) == []
+    assert await Blog.findNumber('count(id)') == 4
+    print('conformance ok: %s' % orm._backend.name)
+
+
+async def replica_routing(path):
+    """
+    读写分离测试：path目录下的primary.db作为主库，replica0.db、replica1.db作为两个只读副本
+    副本是独立的数据库文件，不会自动复制主库的写入，相当于复制延迟无限大的副本
+    """
+    files = [os.path.join(path, name) for name in ('primary.db', 'replica0.db', 'replica1.db')]
+    for database in files:
+        # 在每个库中建表并写入同一条博客
+        await create_pool(loop=None, backend='sqlite', database=database)
+        await orm.execute(orm.create_table_sql(Blog), [])
+        await Blog(id='b1', user_id='u', user_name='n', user_image='i', name='old', summary='s', content='c',
+                   created_at=1.0).save()
+        await destroy_pool()
+    await create_pool(loop=None, backend='sqlite', database=files[0],
+                      replicas=[dict(database=files[1]), dict(database=files[2])])
+
+    # 写操作走主库，只读查询轮流发往两个副本
+    b = await Blog.find('b1')
+    b.name = 'new'
+    await b.update()
+    pools = orm.pool_metrics()['pools']
+    assert pools['primary']['checkouts'] == 1, pools
+    for _ in range(4):
+        assert (await Blog.findAll('id=?', ['b1']))[0].name == 'old'
+    pools = orm.pool_metrics()['pools']
+    # find和4次findAll共5次只读查询，轮询分配给两个副本
+    assert (pools['replica0']['checkouts'], pools['replica1']['checkouts']) == (3, 2), pools
+
+    # primary()中的读取主库（read-your-writes）
+    with orm.primary():
+        assert (await Blog.find('b1')).name == 'new'
+    # 写入之后从落后的副本读到的旧行不能进入行缓存
+    assert (await Blog.find('b1')).name == 'old'
+    assert Blog.__rowcache__.get('b1') is None
+    await destroy_pool()
+    print('replica routing ok')
+
+
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
 
 
     async def test():
-        await create_pool(loop=loop, user='root', password='fjzhang', db='webapp_test')
-        # u = User(name='Test', email='test@example.com', passwd='1234567890', image='about:blank')
-        # await u.save()
-        r = User.findAll()
-        print(r)
+        # python -m www.test sqlite 在内存中的SQLite数据库上运行一致性测试，不需要MySQL
+        # python -m www.test mysql 在MySQL上运行一致性测试，会重建webapp_test中的表
+        # python -m www.test replicas 在临时目录中的SQLite数据库上测试只读副本的路由
+        mode = sys.argv[1] if len(sys.argv) > 1 else None
+        if mode == 'replicas':
+            with tempfile.TemporaryDirectory() as path:
+                await replica_routing(path)
+            return
+        if mode == 'sqlite':
+            await create_pool(loop=loop, backend='sqlite', database=':memory:')
+        else:
+            await create_pool(loop=loop, user='root', password='fjzhang', db='webapp_test')
+        if mode is None:
+            r = await User.findAll()
+            print(r)
+        else:
+            await conformance()
         await destroy_pool()
 
 